@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""
+Headless benchmarks for the hot paths of Pipes: graph searches, board
+generation, solving, connectivity and rendering.
+
+Each benchmark runs in a fresh child process, so its peak memory isn't
+inflated by the ones before it. For each (benchmark, size) this reports:
+- seconds: the time of every repeat, and the best and mean of them.
+- peak_rss_kb: the child's peak resident memory, and op_rss_kb: how much
+  of that was added while running the operation (after its setup).
+- objects: how many more (garbage collected) objects are alive once the
+  operation has run, with its result still held.
+
+Results can be saved as JSON (--output) and compared with an earlier run
+(--compare), to catch regressions.
+"""
+
+import datetime
+import gc
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import random
+import resource
+import sys
+import timeit
+
+import graphlib
+import pipeslib
+
+
+DEFAULT_SIZES = (16, 64, 256, 1000)
+QUICK_SIZES = (16, 64)
+
+
+#### Benchmarks ####
+# Each setup function takes (size, seed), does any work that shouldn't be
+# timed, and returns the operation to time: a function of no arguments.
+
+def setup_bfs(size, seed):
+    graph = graphlib.GridGraph(size, size, connected=True)
+    return lambda: graph.bfs_tree((0, 0))
+
+
+def _weighted_grid(size, seed):
+    graph = graphlib.GridGraph(size, size, connected=True)
+    graph.set_weights(random.Random(seed).random)
+    return graph
+
+
+def setup_dijkstra(size, seed):
+    graph = _weighted_grid(size, seed)
+    return lambda: graph.shortest_path_tree((0, 0))
+
+
+def setup_kruskal(size, seed):
+    graph = _weighted_grid(size, seed)
+    return graph.min_span_tree_kruskal
+
+
+def setup_generate(size, seed):
+    def generate():
+        board = pipeslib.Board(size, seed=seed)
+        board.generate()
+        return board
+    return generate
+
+
+def _jumbled_board(size, seed, board_class=pipeslib.Board):
+    board = board_class(size, seed=seed)
+    board.generate()
+    board.jumble()
+    return board
+
+
+def setup_solve(size, seed):
+    board = _jumbled_board(size, seed)
+
+    def solve():
+        solver = pipeslib.Solver(board.board)
+        for node, square in solver.iter_solved():
+            pass
+        return solver
+    return solve
+
+
+def setup_mark_attached(size, seed):
+    board = _jumbled_board(size, seed)
+    return board.mark_attached
+
+
+def setup_render(size, seed):
+    """A full redraw of the board's view onto an offscreen surface."""
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    import pipes
+
+    pygame.init()
+    # Tiles are converted to the display's format, so there must be one.
+    pygame.display.set_mode((1, 1))
+
+    board = _jumbled_board(size, seed, pipes.PipesBoard)
+    board.reset_view()
+    board.screen = pygame.Surface((pipes.PIC_SIZE * board.view_columns,
+                                   pipes.PIC_SIZE * (board.view_rows + 2)))
+    pipes.PipeSegment.screen = board.screen
+    pipes.Button.screen = board.screen
+    board.font = pygame.font.Font(None, 40)
+    board.solve_button = pipes.Button(
+        board.solve_piece, (board.view_columns - 1, board.view_rows + 1))
+    board.start_time = datetime.datetime.now()
+    board.dirty_rendering = False
+    return board.on_render
+
+
+BENCHMARKS = [
+    ('bfs', setup_bfs),
+    ('dijkstra', setup_dijkstra),
+    ('kruskal', setup_kruskal),
+    ('generate', setup_generate),
+    ('solve', setup_solve),
+    ('mark_attached', setup_mark_attached),
+    ('render', setup_render),
+]
+
+
+#### Measurement ####
+def peak_rss_kb():
+    """The peak resident memory of this process so far, in KB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes, not KB.
+        peak //= 1024
+    return peak
+
+
+def run_benchmark(name, size, seed, repeat):
+    """
+    Run one benchmark; meant to be run in its own process.
+    Returns a dict of its results, with an 'error' if it failed.
+    """
+    result = {'name': name, 'size': size}
+    setup = dict(BENCHMARKS)[name]
+    try:
+        operation = setup(size, seed)
+
+        gc.collect()
+        objects_before = len(gc.get_objects())
+        rss_before = peak_rss_kb()
+
+        start = timeit.default_timer()
+        kept = operation()
+        seconds = [timeit.default_timer() - start]
+
+        gc.collect()
+        result['objects'] = len(gc.get_objects()) - objects_before
+        del kept
+
+        for i in range(repeat - 1):
+            start = timeit.default_timer()
+            operation()
+            seconds.append(timeit.default_timer() - start)
+    except Exception as error:
+        result['error'] = '%s: %s' % (type(error).__name__, error)
+        return result
+
+    result['seconds'] = seconds
+    result['best'] = min(seconds)
+    result['mean'] = sum(seconds) / len(seconds)
+    result['peak_rss_kb'] = peak_rss_kb()
+    result['op_rss_kb'] = result['peak_rss_kb'] - rss_before
+    return result
+
+
+def _run_benchmark(args):
+    return run_benchmark(*args)
+
+
+def run_benchmarks(names, sizes, seed=1, repeat=3):
+    """Yields the result of every benchmark in names at every size."""
+    # A new process per task, so each one's peak memory is its own.
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for name in names:
+            for size in sizes:
+                yield pool.apply(_run_benchmark,
+                                 ((name, size, seed, repeat), ))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+#### Reporting ####
+def format_result(result):
+    line = '%-14s %5d  ' % (result['name'], result['size'])
+    if 'error' in result:
+        return line + 'failed: ' + result['error']
+    line += '%10.4fs best %10.4fs mean %9d KB peak %9d KB op %9d objects' % (
+        result['best'], result['mean'], result['peak_rss_kb'],
+        result['op_rss_kb'], result['objects'])
+    return line
+
+
+def save_results(path, results, sizes, seed, repeat):
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': list(sizes),
+        'seed': seed,
+        'repeat': repeat,
+        'results': results,
+    }
+    with open(path, 'w') as results_file:
+        json.dump(report, results_file, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)['results']
+
+
+def compare_results(old_results, new_results, threshold=0.1):
+    """
+    Print how every benchmark in both runs changed, by best time.
+    Returns the (name, size) of those more than threshold slower.
+    """
+    old_best = dict(((result['name'], result['size']), result.get('best'))
+                    for result in old_results)
+    regressions = []
+    print '%-14s %5s  %10s %10s %8s' % ('benchmark', 'size', 'old', 'new',
+                                        'ratio')
+    for result in new_results:
+        key = (result['name'], result['size'])
+        old = old_best.get(key)
+        new = result.get('best')
+        if not old or new is None:
+            continue
+        ratio = new / old
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  SLOWER'
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print '%-14s %5d  %9.4fs %9.4fs %7.2fx%s' % (key + (old, new, ratio,
+                                                            flag))
+    return regressions
+
+
+def get_command_line_options():
+    parser = optparse.OptionParser(
+        usage='%prog [options] [BENCHMARK ...]',
+        description='Benchmarks: ' + ', '.join(name for name, setup
+                                               in BENCHMARKS) + '.')
+    parser.add_option('-s', '--sizes', dest='sizes',
+                      help='Comma separated board sizes (default: %s).'
+                           % ','.join(str(size) for size in DEFAULT_SIZES),
+                      metavar='SIZES', default=None)
+    parser.add_option('-q', '--quick', dest='quick',
+                      help='Only the small sizes (%s).'
+                           % ','.join(str(size) for size in QUICK_SIZES),
+                      action='store_true', default=False)
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      help='How many times to time each operation.',
+                      metavar='NUM', default=3)
+    parser.add_option('--seed', dest='seed', type='long',
+                      help='The seed for every board and graph weight.',
+                      metavar='NUM', default=1)
+    parser.add_option('-o', '--output', dest='output',
+                      help='Save the results as JSON.',
+                      metavar='FILE', default=None)
+    parser.add_option('-c', '--compare', dest='compare',
+                      help='Compare the results with an earlier --output, '
+                           'and exit with 1 if anything got slower.',
+                      metavar='FILE', default=None)
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+                      help='How much slower counts as slower '
+                           '(default: 0.1, for 10%).',
+                      metavar='FRACTION', default=0.1)
+
+    opts, args = parser.parse_args()
+
+    names = [name for name, setup in BENCHMARKS]
+    for name in args:
+        if name not in names:
+            parser.error('Unknown benchmark: %s' % name)
+    opts.names = args or names
+
+    if opts.sizes is not None:
+        opts.sizes = [int(size) for size in opts.sizes.split(',')]
+    elif opts.quick:
+        opts.sizes = QUICK_SIZES
+    else:
+        opts.sizes = DEFAULT_SIZES
+
+    return opts, args
+
+
+def main():
+    opts, args = get_command_line_options()
+
+    results = []
+    for result in run_benchmarks(opts.names, opts.sizes, opts.seed,
+                                 opts.repeat):
+        print format_result(result)
+        sys.stdout.flush()
+        results.append(result)
+
+    if opts.output is not None:
+        save_results(opts.output, results, opts.sizes, opts.seed,
+                     opts.repeat)
+        print 'Wrote %s' % opts.output
+
+    if opts.compare is not None:
+        print
+        regressions = compare_results(load_results(opts.compare), results,
+                                      opts.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,9 @@ NOTE: Please don't use this for anything important.  Use networkx
 """
 
 import heapq
+import random
+from array import array
+from collections import OrderedDict, deque
 
 
 ##############
@@ -22,19 +25,174 @@ class InvalidGraphError(TypeError):
     pass
 
 
+##############
+# Structures #
+##############
+class DisjointSet(object):
+    """
+    A disjoint-set forest (union-find) with path compression and union by
+    rank.
+    """
+
+    def __init__(self, items=()):
+        """Creates a set for each of items."""
+        self.parents = {}
+        self.ranks = {}
+        self.num_sets = 0
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        """Add item in a set by itself, if it isn't already known."""
+        if item not in self.parents:
+            self.parents[item] = item
+            self.ranks[item] = 0
+            self.num_sets += 1
+
+    def find(self, item):
+        """
+        Returns the representative item of the set containing item.
+        If item was never added, raise a KeyError.
+        """
+        parents = self.parents
+        root = item
+        while parents[root] != root:
+            root = parents[root]
+
+        # Path compression.
+        while item != root:
+            parents[item], item = root, parents[item]
+        return root
+
+    def union(self, item_a, item_b):
+        """
+        Combine the sets containing item_a and item_b.
+        Returns False if they were already the same set.
+        """
+        root_a = self.find(item_a)
+        root_b = self.find(item_b)
+        if root_a == root_b:
+            return False
+
+        rank_a = self.ranks[root_a]
+        rank_b = self.ranks[root_b]
+        if rank_a < rank_b:
+            root_a, root_b = root_b, root_a
+        self.parents[root_b] = root_a
+        if rank_a == rank_b:
+            self.ranks[root_a] += 1
+        self.num_sets -= 1
+        return True
+
+    def connected(self, item_a, item_b):
+        """Returns True if item_a and item_b are in the same set."""
+        return self.find(item_a) == self.find(item_b)
+
+    def __len__(self):
+        """The number of items (not sets)."""
+        return len(self.parents)
+
+
+class ArrayDisjointSet(object):
+    """
+    A DisjointSet of the integers 0 to size - 1, kept in flat arrays
+    instead of dicts: a few bytes per item rather than a few hundred.
+    """
+
+    def __init__(self, size):
+        """Creates a set for each of the integers below size."""
+        self.parents = array('l', range(size))
+        self.ranks = bytearray(size)
+        self.num_sets = size
+
+    def find(self, item):
+        """Returns the representative of the set containing item."""
+        parents = self.parents
+        # Path halving: point every other item on the way at its grandparent.
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    def union(self, item_a, item_b):
+        """
+        Combine the sets containing item_a and item_b.
+        Returns False if they were already the same set.
+        """
+        root_a = self.find(item_a)
+        root_b = self.find(item_b)
+        if root_a == root_b:
+            return False
+
+        ranks = self.ranks
+        if ranks[root_a] < ranks[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parents[root_b] = root_a
+        if ranks[root_a] == ranks[root_b]:
+            ranks[root_a] += 1
+        self.num_sets -= 1
+        return True
+
+    def connected(self, item_a, item_b):
+        """Returns True if item_a and item_b are in the same set."""
+        return self.find(item_a) == self.find(item_b)
+
+    def __len__(self):
+        """The number of items (not sets)."""
+        return len(self.parents)
+
+
+##############
+# Heuristics #
+##############
+def manhattan_distance(node_a, node_b):
+    """
+    The grid distance between two coordinate-tuple nodes. As an astar
+    heuristic, it only never overestimates (so astar stays exact) when every
+    edge between adjacent cells weighs at least 1; see manhattan_heuristic.
+    """
+    return sum(abs(a - b) for a, b in zip(node_a, node_b))
+
+
+def manhattan_heuristic(min_weight):
+    """
+    An astar heuristic for coordinate-tuple nodes whose edges each weigh at
+    least min_weight: manhattan_distance, scaled by min_weight. For a
+    GridGraph, see GridGraph.manhattan_heuristic.
+    """
+    def heuristic(node_a, node_b):
+        return min_weight * manhattan_distance(node_a, node_b)
+    return heuristic
+
+
 #################
 # Graph objects #
 #################
 class DirectedGraph(object):
     """A directed graph."""
 
+    # version: Bumped on every mutation, so cached paths know they're stale.
+    version = 0
+
+    # Incoming edges, built when first needed. See reverse_adjacent.
+    _reverse = None
+    _reverse_version = None
+
+    # The opt-in shortest path cache. See enable_path_cache.
+    path_cache = None
+    path_cache_size = 0
+    cache_hits = 0
+    cache_misses = 0
+
     def __init__(self):
         """Creates a blank graph with no nodes or edges."""
         self.nodes = {}
 
     def create_node(self, node_name):
         """Create a node within the graph."""
-        self.nodes.setdefault(node_name, {})
+        if node_name not in self.nodes:
+            self.nodes[node_name] = {}
+            self.version += 1
 
     def create_edge(self, node_a, node_b, weight=1):
         """
@@ -44,18 +202,113 @@ class DirectedGraph(object):
         self.create_node(node_a)
         self.create_node(node_b)
         self.nodes[node_a][node_b] = weight
+        self.version += 1
 
     def __len__(self):
         """The number of nodes in the graph."""
         return len(self.nodes)
 
+    def __iter__(self):
+        """Iterate over the nodes in the graph."""
+        return iter(self.nodes)
+
+    def __contains__(self, node):
+        """Returns True if node is a node in the graph."""
+        return node in self.nodes
+
+    def neighbors(self, node):
+        """The nodes node has an edge to."""
+        return self.nodes[node].keys()
+
+    def adjacent(self, node):
+        """(adj_node, weight) pairs for every edge out of node."""
+        return self.nodes[node].items()
+
+    def reverse_adjacent(self, node):
+        """(adj_node, weight) pairs for every edge into node."""
+        if self._reverse_version != self.version:
+            self._reverse = {}
+            for node_a, node_b, weight in self.iter_edges():
+                self._reverse.setdefault(node_b, {})[node_a] = weight
+            self._reverse_version = self.version
+        return self._reverse.get(node, {}).items()
+
+    def iter_edges(self):
+        """Yields (node_a, node_b, weight) for every edge."""
+        for node_a, value in self.nodes.items():
+            for node_b, weight in value.items():
+                yield (node_a, node_b, weight)
+
+    def _new_like(self):
+        """A blank graph of the same kind, to be filled with edges."""
+        return type(self)()
+
     def __str__(self):
         """String representation of a graph."""
         ret_str = ["Nodes:"]
-        for node, edges in sorted(self.nodes.items()):
-            ret_str.append("    %s : %s" % (node, edges))
+        for node in sorted(self):
+            ret_str.append("    %s : %s" % (node, dict(self.adjacent(node))))
         return '\n'.join(ret_str)
 
+    def _check_nodes(self, *nodes):
+        """Raise a KeyError if any of nodes isn't a node on the graph."""
+        for node in nodes:
+            if node not in self:
+                raise KeyError("%s isn't a node in this graph." % (node,))
+
+    def _iter_bfs(self, start_nodes, n_distance, n_parent):
+        """
+        Yields nodes in breadth first order from start_nodes, filling in
+        n_distance (hop-count) and n_parent as it goes.
+        """
+        queue = deque()
+        for start_node in start_nodes:
+            if start_node not in n_distance:
+                n_distance[start_node] = 0
+                n_parent[start_node] = None
+                queue.append(start_node)
+
+        while queue:
+            node = queue.popleft()
+            yield node
+
+            for adj_node in self.neighbors(node):
+                if adj_node not in n_distance:
+                    n_distance[adj_node] = n_distance[node] + 1
+                    n_parent[adj_node] = node
+                    queue.append(adj_node)
+
+    def iter_bfs(self, start_node):
+        """
+        Yields every node reachable from start_node in breadth first order.
+        If start_node is not a node on the graph, raise a KeyError.
+        """
+        self._check_nodes(start_node)
+        return self._iter_bfs([start_node], {}, {})
+
+    def bfs_tree(self, start_node):
+        """
+        Returns (n_distance, n_parent): the hop-count to, and the parent on
+        a (not the) shortest path to, every node reachable from start_node.
+
+        If start_node is not a node on the graph, raise a KeyError.
+        """
+        return self.multi_source_bfs([start_node])
+
+    def multi_source_bfs(self, start_nodes):
+        """
+        Like bfs_tree, but distances are to the nearest of start_nodes, whose
+        parents are None.
+
+        If any of start_nodes are not nodes on the graph, raise a KeyError.
+        """
+        self._check_nodes(*start_nodes)
+        n_distance = {}
+        n_parent = {}
+        for node in self._iter_bfs(start_nodes, n_distance, n_parent):
+            pass
+        return (n_distance, n_parent)
+
     def breadth_first_search(self, start_node, end_node):
         """
         Returns a (not the) shortest path between start_node and end_node.
@@ -69,22 +322,11 @@ class DirectedGraph(object):
         KeyError.
         """
 
-        if start_node not in self.nodes:
-            raise KeyError("%s isn't a node in this graph." % (start_node,))
-
-        if end_node not in self.nodes:
-            raise KeyError("%s isn't a node in this graph." % (end_node,))
+        self._check_nodes(start_node, end_node)
 
-        n_distance = {start_node: 0}
-        n_parent = {start_node: None}
-        #n_color = {}
-        #for node in self.nodes:
-        #    n_color[node] = 0
-        #n_color[start_node] = 1
-
-        queue = [start_node]
-        while queue:
-            node = queue.pop(0)
+        n_distance = {}
+        n_parent = {}
+        for node in self._iter_bfs([start_node], n_distance, n_parent):
             if node == end_node:
                 node_path = [end_node]
                 while node_path[-1] != start_node:
@@ -92,14 +334,6 @@ class DirectedGraph(object):
 
                 return reversed(node_path)
 
-            for adj_node in self.nodes[node]:
-                #if not n_color[adj_node]:
-                if not adj_node in n_distance:
-                    #n_color[adj_node] = 1
-                    n_distance[adj_node] = n_distance[node] + 1
-                    n_parent[adj_node] = node
-                    queue.append(adj_node)
-
         # We've found all nodes connected to start_node, and none of them
         # were end_node.
         raise GraphLookupError("%s and %s are not connected." %
@@ -118,18 +352,196 @@ class DirectedGraph(object):
         KeyError.
         """
 
-        if start_node not in self.nodes:
-            raise KeyError("%s isn't a node in this graph." % (start_node,))
+        self._check_nodes(start_node, end_node)
 
-        if end_node not in self.nodes:
-            raise KeyError("%s isn't a node in this graph." % (end_node,))
+        if self.path_cache is not None:
+            n_distance, n_parent = self.shortest_path_tree(start_node)
+        else:
+            n_distance = {}
+            n_parent = {}
+            for cursor_node in self._iter_dijkstra(start_node, n_distance,
+                                                   n_parent):
+                if cursor_node == end_node:
+                    break
 
-        n_distance = {}
-        n_parent = {}
+        if end_node in n_parent:
+            node_path = [end_node]
+            while node_path[-1] != start_node:
+                node_path.append(n_parent[node_path[-1]])
+
+            return (n_distance[end_node], reversed(node_path))
+
+        # All nodes connected to start_node have been searched, and end_node
+        # was not hit.
+        raise GraphLookupError("%s and %s are not connected." %
+                               (repr(start_node), repr(end_node)))
+
+    def _iter_dijkstra(self, start_node, n_distance, n_parent):
+        """
+        Yields nodes in order of distance from start_node, filling in
+        n_distance and n_parent as each one is settled.
+        """
         queue = [(0, start_node, None)]
         while queue:
             distance, cursor_node, parent_node = heapq.heappop(queue)
 
+            if cursor_node in n_parent:
+                continue
+
+            n_distance[cursor_node] = distance
+            n_parent[cursor_node] = parent_node
+            yield cursor_node
+
+            for adj_node, adj_distance in self.adjacent(cursor_node):
+                if adj_node not in n_parent:
+                    heapq.heappush(queue,
+                        (distance + adj_distance, adj_node, cursor_node))
+
+    def shortest_path_tree(self, start_node):
+        """
+        Returns (n_distance, n_parent): the weighted distance to, and the
+        parent on a (not the) shortest path to, every node reachable from
+        start_node.  Served from the path cache, if it's enabled; don't
+        modify the returned dicts.
+
+        If start_node is not a node on the graph, raise a KeyError.
+        """
+        self._check_nodes(start_node)
+
+        cache = self.path_cache
+        if cache is not None:
+            entry = cache.get(start_node)
+            if entry is not None and entry[0] == self.version:
+                self.cache_hits += 1
+                # Most recently used goes last.
+                del cache[start_node]
+                cache[start_node] = entry
+                return entry[1]
+            self.cache_misses += 1
+
+        n_distance = {}
+        n_parent = {}
+        for node in self._iter_dijkstra(start_node, n_distance, n_parent):
+            pass
+
+        if cache is not None:
+            cache.pop(start_node, None)
+            cache[start_node] = (self.version, (n_distance, n_parent))
+            while len(cache) > self.path_cache_size:
+                cache.popitem(last=False)
+        return (n_distance, n_parent)
+
+    def enable_path_cache(self, size=32):
+        """
+        Memoize shortest path trees for up to size start nodes, evicting the
+        least recently used. Any mutation of the graph invalidates them.
+        """
+        self.path_cache = OrderedDict()
+        self.path_cache_size = size
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def disable_path_cache(self):
+        """Stop memoizing shortest path trees, and drop any that are kept."""
+        self.path_cache = None
+
+    def bidirectional_dijkstra(self, start_node, end_node):
+        """
+        Returns a (not the) shortest path between start_node and end_node,
+        like shortest_path_found, but searches from both ends at once and
+        stops when the two searches meet.
+
+        If there's no path between start_node and end_node, raise a
+        GraphLookupError.
+        If start_node or end_node are not nodes on the graph, raise a
+        KeyError.
+        """
+
+        self._check_nodes(start_node, end_node)
+        if start_node == end_node:
+            return (0, iter([start_node]))
+
+        # Each side: (adjacent, n_distance, n_parent, settled, queue)
+        forward = (self.adjacent, {start_node: 0}, {start_node: None},
+                   set(), [(0, start_node)])
+        backward = (self.reverse_adjacent, {end_node: 0}, {end_node: None},
+                    set(), [(0, end_node)])
+
+        best_distance = None
+        meeting_node = None
+        while forward[4] and backward[4]:
+            top_forward = forward[4][0][0]
+            top_backward = backward[4][0][0]
+            if (best_distance is not None and
+                    top_forward + top_backward >= best_distance):
+                break
+
+            if top_forward <= top_backward:
+                side, other_side = forward, backward
+            else:
+                side, other_side = backward, forward
+            adjacent, n_distance, n_parent, settled, queue = side
+            other_distance = other_side[1]
+
+            distance, cursor_node = heapq.heappop(queue)
+            if cursor_node in settled:
+                continue
+            settled.add(cursor_node)
+
+            for adj_node, adj_distance in adjacent(cursor_node):
+                new_distance = distance + adj_distance
+                if (adj_node not in n_distance or
+                        new_distance < n_distance[adj_node]):
+                    n_distance[adj_node] = new_distance
+                    n_parent[adj_node] = cursor_node
+                    heapq.heappush(queue, (new_distance, adj_node))
+
+                if adj_node in other_distance:
+                    total = n_distance[adj_node] + other_distance[adj_node]
+                    if best_distance is None or total < best_distance:
+                        best_distance = total
+                        meeting_node = adj_node
+
+        if meeting_node is None:
+            raise GraphLookupError("%s and %s are not connected." %
+                                   (repr(start_node), repr(end_node)))
+
+        node_path = [meeting_node]
+        while node_path[-1] != start_node:
+            node_path.append(forward[2][node_path[-1]])
+        node_path.reverse()
+        while node_path[-1] != end_node:
+            node_path.append(backward[2][node_path[-1]])
+
+        return (best_distance, iter(node_path))
+
+    def astar(self, start_node, end_node, heuristic=None):
+        """
+        Returns a (not the) shortest path between start_node and end_node,
+        like shortest_path_found, but explores nodes in order of distance
+        plus heuristic(node, end_node).
+
+        heuristic must never overestimate the remaining distance, and must
+        be consistent, for the path to be a shortest one; see
+        manhattan_heuristic.  Without one, this is just Dijkstra.
+
+        If there's no path between start_node and end_node, raise a
+        GraphLookupError.
+        If start_node or end_node are not nodes on the graph, raise a
+        KeyError.
+        """
+
+        self._check_nodes(start_node, end_node)
+        if heuristic is None:
+            heuristic = lambda node_a, node_b: 0
+
+        n_distance = {}
+        n_parent = {}
+        queue = [(heuristic(start_node, end_node), 0, start_node, None)]
+        while queue:
+            estimate, distance, cursor_node, parent_node = \
+                heapq.heappop(queue)
+
             if cursor_node in n_parent:
                 continue
 
@@ -143,10 +555,12 @@ class DirectedGraph(object):
 
                 return (distance, reversed(node_path))
 
-            for adj_node, adj_distance in self.nodes[cursor_node].items():
+            for adj_node, adj_distance in self.adjacent(cursor_node):
                 if adj_node not in n_parent:
-                    heapq.heappush(queue,
-                        (distance + adj_distance, adj_node, cursor_node))
+                    new_distance = distance + adj_distance
+                    heapq.heappush(queue, (
+                        new_distance + heuristic(adj_node, end_node),
+                        new_distance, adj_node, cursor_node))
 
         # All nodes connected to start_node have been searched, and end_node
         # was not hit.
@@ -166,6 +580,10 @@ class UndirectedGraph(DirectedGraph):
         DirectedGraph.create_edge(self, node_a, node_b, weight)
         DirectedGraph.create_edge(self, node_b, node_a, weight)
 
+    def reverse_adjacent(self, node):
+        """(adj_node, weight) pairs for every edge into node."""
+        return self.adjacent(node)
+
     def min_span_tree_kruskal(self):
         """
         Find the minimum weighted tree which completely spans the graph.
@@ -173,35 +591,341 @@ class UndirectedGraph(DirectedGraph):
         """
 
         # Create a new graph to keep track of the min_span_tree.
-        mst = type(self)()
+        mst = self._new_like()
 
-        # sets: a dict of seperate units.
-        sets = dict((node, set([node])) for node in self.nodes)
+        # sets: the seperate units, joined as edges are added.
+        sets = DisjointSet(self)
 
         # edges: a list of edges sorted by weight.
         edges = sorted((weight, (node_a, node_b))
-                       for node_a, value in self.nodes.items()
-                       for node_b, weight in value.items())
+                       for node_a, node_b, weight in self.iter_edges())
 
         # Walk the list of edges, small to large.
         for (weight, (node_a, node_b)) in edges:
-            if sets[node_a] != sets[node_b]:
+            # Combine the two sets, if they're separate.
+            if sets.union(node_a, node_b):
                 # Create the edge
                 mst.create_edge(node_a, node_b, weight)
 
-                # Combine the two sets.
-                set_a, set_b = sorted((sets[node_a], sets[node_b]), key=len)
-                set_b |= set_a
-                for node in set_a:
-                    sets[node] = set_b
-
                 # Check to see if we're done.
-                #if len(mst) == len(sets):
-                if len(set_b) == len(sets):
+                if sets.num_sets == 1:
+                    return mst
+
+        else:
+            raise InvalidGraphError(
+                    "Minimum spanning tree not possible. Graph not connected.")
+
+    def min_span_tree_prim(self):
+        """
+        Find the minimum weighted tree which completely spans the graph.
+        Uses Prim's algorithm with a binary heap. (Cormen, Chapt 24.2)
+        """
+
+        mst = self._new_like()
+        if not len(self):
+            raise InvalidGraphError("Minimum spanning tree not possible. "
+                                    "Graph has no nodes.")
+
+        start_node = next(iter(self))
+        mst.create_node(start_node)
+        in_tree = set([start_node])
+        queue = [(weight, start_node, adj_node)
+                 for adj_node, weight in self.adjacent(start_node)]
+        heapq.heapify(queue)
+        while queue and len(in_tree) < len(self):
+            weight, node_a, node_b = heapq.heappop(queue)
+            if node_b in in_tree:
+                continue
+
+            in_tree.add(node_b)
+            mst.create_edge(node_a, node_b, weight)
+            for adj_node, adj_weight in self.adjacent(node_b):
+                if adj_node not in in_tree:
+                    heapq.heappush(queue, (adj_weight, node_b, adj_node))
+
+        if len(in_tree) != len(self):
+            raise InvalidGraphError(
+                    "Minimum spanning tree not possible. Graph not connected.")
+        return mst
+
+    def random_span_tree_kruskal(self, rng=None):
+        """
+        Find a random tree which completely spans the graph, ignoring edge
+        weights. Kruskal's algorithm over the edges in shuffled order, so
+        there's nothing to sort.
+        """
+        if rng is None:
+            rng = random
+
+        mst = self._new_like()
+        sets = DisjointSet(self)
+        edges = list(self.iter_edges())
+        rng.shuffle(edges)
+
+        for node_a, node_b, weight in edges:
+            if sets.union(node_a, node_b):
+                mst.create_edge(node_a, node_b, weight)
+                if sets.num_sets == 1:
                     return mst
 
+        raise InvalidGraphError(
+                "Spanning tree not possible. Graph not connected.")
+
+    def random_span_tree_wilson(self, rng=None):
+        """
+        Find a uniformly random tree which completely spans the graph,
+        ignoring edge weights. Uses Wilson's algorithm (loop-erased random
+        walks).
+        """
+        if rng is None:
+            rng = random
+
+        mst = self._new_like()
+        if not len(self):
+            raise InvalidGraphError(
+                    "Spanning tree not possible. Graph has no nodes.")
+
+        # A random walk would never finish on a disconnected graph.
+        sets = DisjointSet(self)
+        for node_a, node_b, weight in self.iter_edges():
+            sets.union(node_a, node_b)
+        if sets.num_sets != 1:
+            raise InvalidGraphError(
+                    "Spanning tree not possible. Graph not connected.")
+
+        nodes = list(self)
+        root = rng.choice(nodes)
+        mst.create_node(root)
+        in_tree = set([root])
+        next_node = {}
+        for start_node in nodes:
+            # Walk until we hit the tree; revisits overwrite (erase) loops.
+            node = start_node
+            while node not in in_tree:
+                next_node[node] = rng.choice(list(self.adjacent(node)))
+                node = next_node[node][0]
+
+            # Add the loop-erased walk to the tree.
+            node = start_node
+            while node not in in_tree:
+                in_tree.add(node)
+                adj_node, weight = next_node[node]
+                mst.create_edge(node, adj_node, weight)
+                node = adj_node
+
+        return mst
+
+    def min_span_tree(self, algorithm='kruskal', rng=None):
+        """
+        Find a tree which completely spans the graph. algorithm can be:
+        'kruskal': Minimum weight, via Kruskal's algorithm.
+        'prim': Minimum weight, via Prim's algorithm.
+        'random': A random tree (weights ignored), via shuffled Kruskal.
+        'wilson': A uniformly random tree (weights ignored), via Wilson's.
+
+        rng is the random.Random-like source used by the random algorithms.
+        """
+        if algorithm == 'kruskal':
+            return self.min_span_tree_kruskal()
+        elif algorithm == 'prim':
+            return self.min_span_tree_prim()
+        elif algorithm == 'random':
+            return self.random_span_tree_kruskal(rng)
+        elif algorithm == 'wilson':
+            return self.random_span_tree_wilson(rng)
+        raise ValueError('Invalid spanning tree algorithm: %r' % algorithm)
+
+
+# About how many edges _iter_edges_by_weight sorts at a time.
+EDGES_PER_BUCKET = 4096
+
+
+def _iter_edges_by_weight(weights, present):
+    """
+    Yields the index of every edge with present[index] set, lightest first;
+    equal weights in index order.
+
+    The edges are first spread over buckets by weight, and each bucket is
+    sorted by itself, so only one bucket at a time is a list of Python
+    objects rather than an array.
+    """
+    if not weights:
+        return
+    low = min(weights)
+    high = max(weights)
+    num_buckets = len(weights) // EDGES_PER_BUCKET + 1
+    scale = 0
+    if high > low:
+        scale = (num_buckets - 1) / float(high - low)
+
+    buckets = [array('l') for i in xrange(num_buckets)]
+    for edge, weight in enumerate(weights):
+        if present[edge]:
+            buckets[int((weight - low) * scale)].append(edge)
+
+    for number in xrange(num_buckets):
+        bucket = buckets[number]
+        buckets[number] = None
+        for edge in sorted(bucket, key=weights.__getitem__):
+            yield edge
+
+
+class GridGraph(UndirectedGraph):
+    """
+    An undirected graph whose nodes are the (x, y) cells of a width by height
+    grid, with edges only between horizontally or vertically adjacent cells.
+
+    Neighbors are computed from coordinates. Edges live in flat arrays:
+    horizontal edge (x, y)-(x + 1, y) at y * (width - 1) + x, and vertical
+    edge (x, y)-(x, y + 1) at y * width + x.
+    """
+
+    def __init__(self, width, height, connected=False, weight=1):
+        """
+        Creates a grid with no edges, or, if connected is True, with every
+        edge at weight, weight.
+        """
+        self.width = width
+        self.height = height
+        num_h_edges = max(width - 1, 0) * height
+        num_v_edges = width * max(height - 1, 0)
+        self.h_edges = bytearray([int(connected)]) * num_h_edges
+        self.v_edges = bytearray([int(connected)]) * num_v_edges
+        self.h_weights = array('d', [weight]) * num_h_edges
+        self.v_weights = array('d', [weight]) * num_v_edges
+
+    def set_weights(self, weight):
+        """Set every edge's weight to the result of calling weight()."""
+        self.h_weights = array('d', (weight() for _ in self.h_weights))
+        self.v_weights = array('d', (weight() for _ in self.v_weights))
+        self.version += 1
+
+    def create_node(self, node_name):
+        """Every node on the grid already exists; others can't be made."""
+        if node_name not in self:
+            raise KeyError("%s isn't a node in this graph." % (node_name,))
+
+    def _edge_slot(self, node_a, node_b):
+        """(edges, weights, index) holding the edge between two nodes."""
+        self.create_node(node_a)
+        self.create_node(node_b)
+        (x_a, y_a), (x_b, y_b) = sorted((node_a, node_b))
+        if y_a == y_b and x_b == x_a + 1:
+            return self.h_edges, self.h_weights, y_a * (self.width - 1) + x_a
+        if x_a == x_b and y_b == y_a + 1:
+            return self.v_edges, self.v_weights, y_a * self.width + x_a
+        raise InvalidGraphError("%s and %s aren't adjacent on the grid." %
+                                (node_a, node_b))
+
+    def create_edge(self, node_a, node_b, weight=1):
+        """
+        Create an undirected (two way) edge between two adjacent cells with
+        weight, weight.
+        """
+        edges, weights, index = self._edge_slot(node_a, node_b)
+        edges[index] = 1
+        weights[index] = weight
+        self.version += 1
+
+    def __len__(self):
+        """The number of nodes in the graph."""
+        return self.width * self.height
+
+    def __iter__(self):
+        """Iterate over the nodes in the graph, row by row."""
+        for y in range(self.height):
+            for x in range(self.width):
+                yield (x, y)
+
+    def __contains__(self, node):
+        """Returns True if node is a cell on the grid."""
+        try:
+            x, y = node
+        except (TypeError, ValueError):
+            return False
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def adjacent(self, node):
+        """(adj_node, weight) pairs for every edge out of node."""
+        x, y = node
+        width = self.width
+        adjacent = []
+        if y > 0 and self.v_edges[(y - 1) * width + x]:
+            adjacent.append(((x, y - 1), self.v_weights[(y - 1) * width + x]))
+        if x < width - 1 and self.h_edges[y * (width - 1) + x]:
+            adjacent.append(((x + 1, y), self.h_weights[y * (width - 1) + x]))
+        if y < self.height - 1 and self.v_edges[y * width + x]:
+            adjacent.append(((x, y + 1), self.v_weights[y * width + x]))
+        if x > 0 and self.h_edges[y * (width - 1) + x - 1]:
+            adjacent.append(((x - 1, y),
+                             self.h_weights[y * (width - 1) + x - 1]))
+        return adjacent
+
+    def neighbors(self, node):
+        """The nodes node has an edge to."""
+        return [adj_node for adj_node, weight in self.adjacent(node)]
+
+    def manhattan_heuristic(self):
+        """
+        An astar heuristic for this grid as it's weighted now: the
+        manhattan_heuristic for its lightest edge.
+        """
+        weights = [weight for present, weight
+                   in zip(self.h_edges + self.v_edges,
+                          self.h_weights + self.v_weights)
+                   if present]
+        return manhattan_heuristic(min(weights) if weights else 0)
+
+    def min_span_tree_kruskal(self):
+        """
+        Kruskal's algorithm on the grid's own arrays: edges are indexes into
+        h_weights and v_weights (see _iter_edges_by_weight), and cells are
+        unioned as integer ids (y * width + x) in an ArrayDisjointSet.
+        """
+        width = self.width
+        h_width = width - 1
+        num_h_edges = len(self.h_edges)
+        # Edge e is horizontal edge e, or vertical edge e - num_h_edges.
+        weights = self.h_weights + self.v_weights
+        present = self.h_edges + self.v_edges
+
+        in_tree = bytearray(len(present))
+        sets = ArrayDisjointSet(len(self))
+        for edge in _iter_edges_by_weight(weights, present):
+            if edge < num_h_edges:
+                y, x = divmod(edge, h_width)
+                cell_a = y * width + x
+                cell_b = cell_a + 1
+            else:
+                cell_a = edge - num_h_edges
+                cell_b = cell_a + width
+            if sets.union(cell_a, cell_b):
+                in_tree[edge] = 1
+                if sets.num_sets == 1:
+                    break
         else:
             raise InvalidGraphError(
                     "Minimum spanning tree not possible. Graph not connected.")
 
-    min_span_tree = min_span_tree_kruskal
+        mst = self._new_like()
+        mst.h_edges = in_tree[:num_h_edges]
+        mst.v_edges = in_tree[num_h_edges:]
+        mst.h_weights = self.h_weights[:]
+        mst.v_weights = self.v_weights[:]
+        return mst
+
+    def iter_edges(self):
+        """Yields (node_a, node_b, weight) once for every edge."""
+        h_width = self.width - 1
+        for index, present in enumerate(self.h_edges):
+            if present:
+                y, x = divmod(index, h_width)
+                yield ((x, y), (x + 1, y), self.h_weights[index])
+        for index, present in enumerate(self.v_edges):
+            if present:
+                y, x = divmod(index, self.width)
+                yield ((x, y), (x, y + 1), self.v_weights[index])
+
+    def _new_like(self):
+        """A blank grid of the same size, to be filled with edges."""
+        return type(self)(self.width, self.height)
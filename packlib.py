@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Compact binary puzzle packs, readable by random access through mmap.
+
+A pack file is laid out as:
+    header:  MAGIC, then the format VERSION (uint16) and 6 reserved bytes.
+    records: One per puzzle; see RECORD_HEADER. After the header come the
+             squares' 4-bit connection masks, row by row, two per byte (the
+             first square in the low nibble).
+    index:   The offset of every record (uint64).
+    footer:  The offset of the index and the number of puzzles (uint64s),
+             then END_MAGIC.
+All numbers are little-endian.
+"""
+
+import mmap
+import os
+import struct
+
+
+MAGIC = b'PIPEPACK'
+END_MAGIC = b'PACKEND\0'
+VERSION = 1
+
+HEADER = struct.Struct('<8sH6x')
+# width, height, source x, source y, seed
+RECORD_HEADER = struct.Struct('<HHHHQ')
+INDEX_ENTRY = struct.Struct('<Q')
+FOOTER = struct.Struct('<QQ8s')
+
+
+# Translation tables from a packed byte to one of its masks.
+_LOW_NIBBLES = bytes(bytearray(byte & 0xf for byte in range(256)))
+_HIGH_NIBBLES = bytes(bytearray(byte >> 4 for byte in range(256)))
+
+
+class PackError(ValueError):
+    """A file that isn't a (valid) puzzle pack."""
+    pass
+
+
+def pack_masks(masks):
+    """Pack a sequence of 4-bit masks two to a byte."""
+    packed = bytearray((len(masks) + 1) // 2)
+    for index, mask in enumerate(masks):
+        packed[index >> 1] |= (mask & 0xf) << (4 * (index & 1))
+    return packed
+
+
+class PuzzleRecord(object):
+    """
+    One puzzle in a PuzzlePack. Only the record header is decoded up front;
+    masks are read straight out of the mapped file.
+    """
+
+    def __init__(self, data, offset):
+        (self.width, self.height, source_x, source_y,
+         self.seed) = RECORD_HEADER.unpack_from(data, offset)
+        self.source = (source_x, source_y)
+        self._data = data
+        self._masks_offset = offset + RECORD_HEADER.size
+
+    def __len__(self):
+        """The number of squares."""
+        return self.width * self.height
+
+    def mask(self, node):
+        """The connection mask of the square at node."""
+        x, y = node
+        index = y * self.width + x
+        byte = ord(self._data[self._masks_offset + (index >> 1)])
+        return (byte >> (4 * (index & 1))) & 0xf
+
+    def masks(self):
+        """Every square's connection mask, row by row, as a bytearray."""
+        size = len(self)
+        start = self._masks_offset
+        packed = bytearray(self._data[start:start + (size + 1) // 2])
+        masks = bytearray(size)
+        masks[0::2] = packed.translate(_LOW_NIBBLES)
+        masks[1::2] = packed[:size // 2].translate(_HIGH_NIBBLES)
+        return masks
+
+
+class PuzzlePack(object):
+    """
+    A read-only, memory-mapped pack of puzzles, indexable like a list. Only
+    packs of this format VERSION can be read.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            self._file.close()
+            raise PackError('%s is not a puzzle pack.' % (path,))
+
+        data = self._data
+        magic = version = None
+        if len(data) >= HEADER.size + FOOTER.size:
+            magic, version = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            self.close()
+            raise PackError('%s is not a puzzle pack.' % (path,))
+        if version != VERSION:
+            self.close()
+            raise PackError('%s is a version %d puzzle pack; expected '
+                            'version %d.' % (path, version, VERSION))
+        self._index_offset, self._count, end_magic = FOOTER.unpack_from(
+            data, len(data) - FOOTER.size)
+        if end_magic != END_MAGIC:
+            self.close()
+            raise PackError('%s is truncated or unfinished.' % (path,))
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('Puzzle %d is not in this pack.' % (index,))
+        offset, = INDEX_ENTRY.unpack_from(
+            self._data, self._index_offset + INDEX_ENTRY.size * index)
+        return PuzzleRecord(self._data, offset)
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PackWriter(object):
+    """
+    Writes puzzles to a pack file. The index is written by close(), so use
+    it as a context manager. With append, puzzles are added to an existing
+    pack instead of replacing it; a pack of another format version can't be
+    appended to (PackError).
+    """
+
+    def __init__(self, path, append=False):
+        self._offsets = []
+        if append and os.path.exists(path):
+            with PuzzlePack(path) as pack:
+                index_offset = pack._index_offset
+                self._offsets = [INDEX_ENTRY.unpack_from(
+                    pack._data, index_offset + INDEX_ENTRY.size * index)[0]
+                    for index in range(len(pack))]
+            self._file = open(path, 'r+b')
+            self._file.seek(index_offset)
+            self._file.truncate()
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(HEADER.pack(MAGIC, VERSION))
+
+    def write(self, width, height, source, seed, masks):
+        """Add a puzzle; masks holds every square's mask, row by row."""
+        if len(masks) != width * height:
+            raise ValueError('Expected %d masks, got %d.' %
+                             (width * height, len(masks)))
+        self._offsets.append(self._file.tell())
+        source_x, source_y = source
+        self._file.write(RECORD_HEADER.pack(width, height, source_x, source_y,
+                                            seed or 0))
+        self._file.write(pack_masks(masks))
+
+    def close(self):
+        """Write the index and footer, and close the file."""
+        index_offset = self._file.tell()
+        for offset in self._offsets:
+            self._file.write(INDEX_ENTRY.pack(offset))
+        self._file.write(FOOTER.pack(index_offset, len(self._offsets),
+                                     END_MAGIC))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
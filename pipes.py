@@ -3,72 +3,125 @@
 """This is a game for playing pipes. :-)"""
 
 import datetime
+import logging
 import optparse
 import os
 import pygame
-import random
-from collections import deque
 
-import graphlib
 import cevent
+import packlib
+import pipeslib
 
 
+log = logging.getLogger('pipes')
+
 PICS_DIR = os.path.join('pics', 'pipes_3D')
 PIC_SIZE = 32
 
-
-class PipeSegment(object):
-    """A representation of a segfmfent on the Pipes board."""
+# Tiles are (major, minor); the atlas has a row per major, a column per minor.
+NUM_MAJORS = 8
+NUM_MINORS = 16
+
+# The most (columns, rows) shown at once; bigger boards scroll.
+MAX_VIEW_SIZE = (40, 20)
+# How far (columns, rows) each arrow key scrolls.
+PAN_KEYS = {
+    pygame.K_LEFT: (-1, 0),
+    pygame.K_RIGHT: (1, 0),
+    pygame.K_UP: (0, -1),
+    pygame.K_DOWN: (0, 1),
+}
+# How many rows a click of the mouse wheel scrolls.
+WHEEL_STEP = 3
+
+# The event-driven loop wakes up with this event every CLOCK_INTERVAL
+# milliseconds, to keep the clock ticking.
+CLOCK_EVENT = pygame.USEREVENT
+CLOCK_INTERVAL = 500
+
+# The most background solver results taken in one loop, so a flood of them
+# can't hold up a frame.
+MAX_RESULTS_PER_LOOP = 5000
+
+
+def get_tile_file(major, minor):
+    return os.path.join(PICS_DIR, '%03d_%03d.png' % (major, minor))
+
+
+def get_atlas_file():
+    """The packed atlas sits next to the tile directory: pics/pipes_3D.png"""
+    return os.path.normpath(PICS_DIR) + '.png'
+
+
+def build_atlas(atlas_file=None):
+    """Pack every tile in PICS_DIR into a single atlas image."""
+    if atlas_file is None:
+        atlas_file = get_atlas_file()
+
+    tile_width, tile_height = pygame.image.load(get_tile_file(0, 0)).get_size()
+    atlas = pygame.Surface((tile_width * NUM_MINORS, tile_height * NUM_MAJORS),
+                           pygame.SRCALPHA, 32)
+    atlas.fill((0, 0, 0, 0))
+    for major in range(NUM_MAJORS):
+        for minor in range(NUM_MINORS):
+            tile = pygame.image.load(get_tile_file(major, minor))
+            atlas.blit(tile, (tile_width * minor, tile_height * major))
+    pygame.image.save(atlas, atlas_file)
+
+
+class TileCache(object):
+    """
+    Tile images keyed by (major, minor), loaded the first time each is used.
+
+    Tiles come from the packed atlas if there is one, or else from the
+    individual PNGs in PICS_DIR. Either way they're converted to the
+    display's pixel format once, so blits don't have to.
+    """
+
+    def __init__(self):
+        self.tiles = {}
+        self.atlas = None
+
+    def __getitem__(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = self.load(key)
+        return tile
+
+    def load(self, key):
+        major, minor = key
+        atlas = self.get_atlas()
+        if atlas is None:
+            tile = pygame.image.load(get_tile_file(major, minor))
+            if pygame.display.get_surface() is not None:
+                tile = tile.convert()
+            return tile
+
+        tile_width = atlas.get_width() // NUM_MINORS
+        tile_height = atlas.get_height() // NUM_MAJORS
+        return atlas.subsurface((tile_width * minor, tile_height * major,
+                                 tile_width, tile_height))
+
+    def get_atlas(self):
+        """The converted atlas, or None if there isn't an atlas file."""
+        if self.atlas is None:
+            atlas_file = get_atlas_file()
+            if not os.path.exists(atlas_file):
+                return None
+            self.atlas = pygame.image.load(atlas_file)
+            if pygame.display.get_surface() is not None:
+                self.atlas = self.atlas.convert_alpha()
+        return self.atlas
+
+
+class PipeSegment(pipeslib.PipeSegment):
+    """A PipeSegment that can draw itself."""
 
     screen = None
+    # view_origin: The board square drawn at the top left of the screen.
+    view_origin = (0, 0)
 
-    tiles = {}
-
-    min_x = 0
-    min_y = 0
-    max_x = 0
-    max_y = 0
-
-    initial_end_sets = {
-        'end-cap': tuple(map(frozenset, [[0],
-                                         [1],
-                                         [2],
-                                         [3]])),
-        'angle': tuple(map(frozenset, [[0, 1],
-                                       [1, 2],
-                                       [2, 3],
-                                       [3, 0]])),
-        'straight': tuple(map(frozenset, [[0, 2],
-                                          [1, 3]])),
-        'tee': tuple(map(frozenset, [[0, 1, 2],
-                                     [1, 2, 3],
-                                     [2, 3, 0],
-                                     [3, 0, 1]])),
-        'cross': tuple(map(frozenset, [[0, 1, 2, 3]])),
-    }
-
-    set_chars = {
-        # End-Caps
-        frozenset([0]): u'\u2579',
-        frozenset([1]): u'\u257a',
-        frozenset([2]): u'\u257b',
-        frozenset([3]): u'\u2578',
-        # Angles
-        frozenset([0, 1]): u'\u255a',
-        frozenset([1, 2]): u'\u2554',
-        frozenset([2, 3]): u'\u2557',
-        frozenset([3, 0]): u'\u255d',
-        # Straights
-        frozenset([0, 2]): u'\u2551',
-        frozenset([1, 3]): u'\u2550',
-        # T's
-        frozenset([0, 1, 2]): u'\u2560',
-        frozenset([1, 2, 3]): u'\u2566',
-        frozenset([2, 3, 0]): u'\u2563',
-        frozenset([3, 0, 1]): u'\u2569',
-        # Crosses
-        frozenset([0, 1, 2, 3]): u'\u256c',
-    }
+    tiles = TileCache()
 
     set_pic_nums = {
         # No connection
@@ -96,69 +149,9 @@ class PipeSegment(object):
     }
 
     def __init__(self, initial_connections, node):
-        """
-        Constructor for a pipe segment. seg_type can be:
-        'end-cap', 'angle', 'straight', 'tee', or 'cross'.
-        """
-        for connections in self.initial_end_sets.values():
-            if initial_connections in connections:
-                self.connections = list(connections)
-                break
-        else:
-            msg = 'Invalid initial_connections: %r' % initial_connections
-            raise ValueError(msg)
-        self.cursor = self.connections.index(initial_connections)
-        self.node = node
-        x, y = node
-        self.min_x = min(self.min_x, x)
-        self.min_y = min(self.min_y, y)
-        self.max_x = max(self.max_x, x)
-        self.max_y = max(self.max_y, y)
-
-        self.set_tile_pics()
+        pipeslib.PipeSegment.__init__(self, initial_connections, node)
 
         self.is_highlighted = False
-        self.is_attached = False
-
-    def set_tile_pics(self):
-        if self.tiles:
-            return
-
-        for major in range(8):
-            for minor in range(16):
-                pic_file = os.path.join(PICS_DIR, '%03d_%03d.png' % (major,
-                                                                     minor))
-                self.tiles[(major, minor)] = pygame.image.load(pic_file)
-
-    def on_init(self):
-        """
-        Jumble the square such that it is random,
-        ...but different than initialized.
-        """
-        if self.is_set():
-            return
-
-        possible_cursors = range(len(self.connections))
-        possible_cursors.remove(self.cursor)
-        self.cursor = random.choice(possible_cursors)
-
-    def rotate_right(self):
-        self.cursor += 1
-        if self.cursor >= len(self.connections):
-            self.cursor = 0
-
-    def rotate_left(self):
-        self.cursor -= 1
-        if self.cursor < 0:
-            self.cursor = len(self.connections) - 1
-
-    def attached_to_source(self):
-        """Returns True if self is attached to the source."""
-        return self.is_attached
-
-    def is_set(self):
-        """Returns True if the segment only has one possibility."""
-        return 1 == len(self.connections)
 
     def get_major(self):
         """f
@@ -182,131 +175,15 @@ class PipeSegment(object):
         minor = self.set_pic_nums[self.get_connection()]
         return minor
 
-    def get_connection(self):
-        return self.connections[self.cursor]
-
     def on_render(self):
         """Draws the square."""
         major = self.get_major()
         minor = self.get_minor()
         tile = self.tiles[(major, minor)]
         x, y = self.node
-        self.screen.blit(tile, (PIC_SIZE * x, PIC_SIZE * y))
-
-    def __unicode__(self):
-        """A unicode representation of a pipe segment."""
-        return self.set_chars[self.connections[self.cursor]]
-
-    def clone(self):
-        new_copy = type(self)(self.get_connection(), self.node)
-        return new_copy
-
-    def get_neighbors(self):
-        """
-        Returns all nodes next to this node.
-        NOTE: This includes squares off the board.
-        """
-
-        x, y = self.node
-        neighbors = [
-            (x, y - 1),
-            (x + 1, y),
-            (x, y + 1),
-            (x - 1, y),
-        ]
-        return neighbors
-
-    def get_possible_connected_nodes(self):
-        """
-        Returns all possible node-positions that could connect to this node.
-        NOTE: This includes squares off the board.
-        """
-        x, y = self.node
-        connected_nodes = deque()
-        for direction in self.get_connection():
-            if direction == 0:
-                connected_nodes.append((x, y - 1))
-            elif direction == 1:
-                connected_nodes.append((x + 1, y))
-            elif direction == 2:
-                connected_nodes.append((x, y + 1))
-            elif direction == 3:
-                connected_nodes.append((x - 1, y))
-        return connected_nodes
-
-    def get_links(self, pos):
-        sx, sy = self.node
-        rx, ry = pos
-        dx = sx - rx
-        dy = sy - ry
-
-        link_map = {
-            (0, 1): (0, 2),
-            (0, -1): (2, 0),
-            (1, 0): (3, 1),
-            (-1, 0): (1, 3),
-        }
-
-        return link_map.get((dx, dy))
-
-    def is_connected_to(self, pos):
-        links = self.get_links(pos)
-        my_link = links[0]
-        return my_link in self.get_connection()
-
-    def delete_connection(self, bad_option):
-        """Delete any connectfion that contains bad_option."""
-        option = self.get_connection()
-        for connection in list(self.connections):
-            if bad_option in connection:
-                self.connections.remove(connection)
-
-        self.cursor = 0
-        if option in self.connections:
-            self.cursor = self.connections.index(option)
-
-    def is_a_nub(self):
-        """
-        Returns true if this square will only connect to one other square.
-        """
-        return len(self.get_connection()) == 1
-
-    def learn_from_neighbor(self, n_square):
-        """Returns True if self is modified based on data within neighbor."""
-        old_connections = list(self.connections)
-        cursor_connection = self.get_connection()
-        my_link, his_link = self.get_links(n_square.node)
-        his_connections = n_square.connections
-
-        # Check positives first.
-        link_missing = False
-        for his_connection in his_connections:
-            link_missing |= (his_link not in his_connection)
-        if not link_missing:
-            # Our link MUST be used.
-            for my_connection in list(self.connections):
-                if my_link not in my_connection:
-                    self.connections.remove(my_connection)
-
-        # Check negatives next.
-        link_present = False
-        for his_connection in his_connections:
-            link_present |= (his_link in his_connection)
-        if not link_present or (self.is_a_nub() and n_square.is_a_nub()):
-            # Our link MUST NOT be used.
-            for my_connection in list(self.connections):
-                if my_link in my_connection:
-                    self.connections.remove(my_connection)
-
-        # If we didn't modify anything, we're done.
-        if self.connections == old_connections:
-            return False
-
-        # Make sure our cursor isn't pointing to nothing.
-        self.cursor = 0
-        if cursor_connection in self.connections:
-            self.cursor = self.connections.index(cursor_connection)
-        return True
+        view_x, view_y = self.view_origin
+        self.screen.blit(tile, (PIC_SIZE * (x - view_x),
+                                PIC_SIZE * (y - view_y)))
 
 
 class Button(object):
@@ -337,106 +214,72 @@ class Button(object):
         return (node == self.node)
 
 
-class Solver(object):
-    def __init__(self, board):
-        self.board = {}
-
-        self.min_x = 0
-        self.min_y = 0
-        self.max_x = 0
-        self.max_y = 0
-
-        for node, square in board.items():
-            self.board[node] = square.clone()
-            self.board[node].cursor = 0
-
-            x, y = node
-            self.min_x = min(self.min_x, x)
-            self.max_x = max(self.max_x, x)
-            self.min_y = min(self.min_y, y)
-            self.max_y = max(self.max_y, y)
-
-    def iter_solved(self):
-        for node in self.iter_altered():
-            square = self.board[node]
-            if square.is_set():
-                yield (node, square)
-
-    def iter_altered(self):
-        for node in self.solve_edges():
-            yield node
-        for node in self.solve_all():
-            yield node
-
-    def solve_edges(self):
-        for node, square in self.board.items():
-            x, y = node
-            if x == self.min_x:
-                square.delete_connection(3)
-            if y == self.min_y:
-                square.delete_connection(0)
-            if x == self.max_x:
-                square.delete_connection(1)
-            if y == self.max_y:
-                square.delete_connection(2)
-            if square.is_set():
-                yield node
-
-    def solve_all(self):
-        altered_something = True
-        while altered_something:
-            altered_something = False
-
-            num_solved = len(filter(PipeSegment.is_set, self.board.values()))
-            print 'num_solved = ' + repr(num_solved)
-            if num_solved == len(self.board):
-                print 'Solved them all!'
-                break
-
-            for node, square in self.board.items():
-                altered_this = self.solve_square(square)
-                altered_something |= altered_this
-                if altered_this:
-                    yield node
-
-    def solve_square(self, square):
-        modified = False
-        if square.is_set():
-            return modified
-        for n_node in square.get_neighbors():
-            try:
-                n_square = self.board[n_node]
-            except (KeyError, IndexError):
-                continue
-            modified |= square.learn_from_neighbor(n_square)
-        return modified
-
-
-class PipesBoard(cevent.CEvent):
+class PipesBoard(pipeslib.Board, cevent.CEvent):
     """A class representing the game: Pipes!"""
 
-    def __init__(self, columns, rows=None):
+    segment_class = PipeSegment
+
+    def __init__(self, columns, rows=None, generator='kruskal',
+                 dirty_rendering=True, fps=30, pack_file=None,
+                 puzzle_index=0, save_file=None, seed=None, view_size=None,
+                 event_driven=True, solver_process=False):
         """
         Constructor for PipesBoard; size is either an int or pair of ints.
-        """
-        x = int(columns)
-        y = x
-        if rows:
-            y = int(rows)
+        generator is the graphlib spanning tree algorithm used by generate.
+        seed reproduces a board (see pipeslib.Board.reseed).
+
+        With dirty_rendering, only squares that changed are redrawn each
+        frame. fps caps the frame rate (None or 0 for no cap).
 
-        self.xs = range(x)
-        self.ys = range(y)
+        view_size is the most (columns, rows) shown at once; bigger boards
+        scroll with the arrow keys, the mouse wheel (with shift, sideways)
+        or by dragging with the middle button.
+
+        With event_driven, the main loop sleeps until something happens
+        (at the latest, the clock needing to tick) instead of polling.
+
+        If pack_file is given, puzzle number puzzle_index is loaded from it
+        instead of generating a board. Pressing 's' adds the board to the
+        pack save_file, and 'n' moves on to a new board (or the next one in
+        the pack). Ctrl+Z undoes a move, and Ctrl+Y (or Ctrl+Shift+Z) redoes
+        it.
+
+        Hints come from a pipeslib.BackgroundSolver, run in a thread or,
+        with solver_process, a process.
+        """
+        pipeslib.Board.__init__(self, columns, rows, generator, seed)
+        self.pack_file = pack_file
+        self.puzzle_index = puzzle_index
+        self.save_file = save_file
 
         self.screen = None
         self.solve_button = None
         self.font = None
 
-        self.board = {}
-        self.source = (0, 0)
-
-        self.solver = None
-        self.solved = None
-        self.ignored_solved = set()
+        self.dirty_rendering = dirty_rendering
+        self.fps = fps
+        self.event_driven = event_driven
+        self.clock = None
+        # highlighted: The node of the square under the mouse, or None.
+        self.highlighted = None
+
+        self.view_size = view_size or MAX_VIEW_SIZE
+        # view_x, view_y: The board square at the top left of the window.
+        # view_columns, view_rows: How many squares the window shows.
+        # _drag_pos: Where the middle button drag was last moved from.
+        self.view_x = 0
+        self.view_y = 0
+        self.view_columns = 0
+        self.view_rows = 0
+        self._drag_pos = None
+        # _dirty: Nodes whose squares need redrawing.
+        # _redraw_all: The next frame should redraw everything.
+        self._dirty = set()
+        self._redraw_all = True
+        self._status_text = None
+
+        self.solver_process = solver_process
+        self.background_solver = None
 
         self._no_clicky = False
         self._is_running = False
@@ -445,71 +288,82 @@ class PipesBoard(cevent.CEvent):
 
     def on_init(self):
         """Creates the pygame board."""
-
-        self.generate()
-        print unicode(self)
-
-        text_height = PIC_SIZE * 2
-        width = PIC_SIZE * len(self.xs)
-        height = PIC_SIZE * len(self.ys) + text_height
-
         pygame.init()
-        self.screen = pygame.display.set_mode((width, height))
         self.font = pygame.font.Font(None, 40)
-
-        PipeSegment.screen = self.screen
-        Button.screen = self.screen
+        self.clock = pygame.time.Clock()
+        # Holding an arrow key keeps scrolling.
+        pygame.key.set_repeat(250, 30)
 
         self._is_running = True
+        self.start_board()
+
+    def start_board(self):
+        """Set up a board to play, and start solving it in the background."""
+        if self.pack_file is None:
+            self.generate()
+        else:
+            self.load_from_pack(self.pack_file, self.puzzle_index)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(u'\n%s', unicode(self))
+        log.info('Seed: %d', self.seed)
 
-        for square in self.board.values():
-            square.on_init()
+        self.reset_view()
+        self.set_up_screen()
 
-        self.solver = Solver(self.board)
-        self.solved = self.solver.iter_solved()
-        self.solve_button = Button(self.solve_piece,
-                                   (len(self.xs) - 1, len(self.ys) + 1))
+        self.highlighted = None
+        self.jumble()
+        self.start_solving()
 
+        self._no_clicky = False
         self.start_time = datetime.datetime.now()
+        self.finish_time = None
+
+    def set_up_screen(self):
+        """Size the window to the view; it's only remade if that changed."""
+        text_height = PIC_SIZE * 2
+        width = PIC_SIZE * self.view_columns
+        height = PIC_SIZE * self.view_rows + text_height
+        if self.screen is None or self.screen.get_size() != (width, height):
+            self.screen = pygame.display.set_mode((width, height))
+        self._redraw_all = True
 
-    def generate(self):
-        """Generate a starting Pipes setup."""
-
-        graph = graphlib.UndirectedGraph()
-        for x in self.xs:
-            for y in self.ys:
-                if x != 0:
-                    graph.create_edge((x, y), (x - 1, y), random.random())
-                if y != 0:
-                    graph.create_edge((x, y), (x, y - 1), random.random())
-
-        graph = graph.min_span_tree()
-        for node, links in sorted(graph.nodes.items()):
-            connections = []
-            sx, sy = node
-            for rx, ry in links:
-                if sx == rx and sy == ry + 1:
-                    connections.append(0)
-                elif sx == rx - 1 and sy == ry:
-                    connections.append(1)
-                elif sx == rx and sy == ry - 1:
-                    connections.append(2)
-                elif sx == rx + 1 and sy == ry:
-                    connections.append(3)
-
-            self.board[node] = PipeSegment(frozenset(connections), node)
-
-        self.source = random.choice(self.board.keys())
-
-    def __unicode__(self):
-        """A unicode grid of the pipes grid."""
-        ret_str = []
-        for y in self.ys:
-            for x in self.xs:
-                ret_str.append(unicode(self.board[(x, y)]))
-            ret_str.append(u'\n')
-
-        return u''.join(ret_str)
+        PipeSegment.screen = self.screen
+        Button.screen = self.screen
+        self.solve_button = Button(self.solve_piece,
+                                   (self.view_columns - 1, self.view_rows + 1))
+
+    def new_board(self):
+        """Give up on this board for a new one, or the pack's next one."""
+        if self.pack_file is None:
+            self.reseed()
+        else:
+            self.puzzle_index += 1
+            with packlib.PuzzlePack(self.pack_file) as pack:
+                if self.puzzle_index >= len(pack):
+                    self.puzzle_index = 0
+        self.start_board()
+        if self.event_driven:
+            # The clock stops when a board is finished.
+            pygame.time.set_timer(CLOCK_EVENT, CLOCK_INTERVAL)
+
+    #### Solving in the background ####
+    def start_solving(self):
+        """Start working out hints for the board, dropping any old ones."""
+        if self.background_solver is not None:
+            self.background_solver.cancel()
+        # A BitBoard solver makes no objects per square, so a thread never
+        # holds up the window with their garbage collection.
+        self.background_solver = pipeslib.BackgroundSolver(
+            self, self.solver_process, propagation='bitmask')
+        self.background_solver.start()
+
+    def collect_known(self):
+        """Take what the background solver has found so far."""
+        if self.background_solver is None:
+            return
+        for node, connection in self.background_solver.drain(
+                MAX_RESULTS_PER_LOOP):
+            self.add_known(node, connection)
 
     #### Events ####
     def on_event(self, event):
@@ -536,84 +390,176 @@ class PipesBoard(cevent.CEvent):
             self.on_mouse_move(event)
 
         elif event.type == pygame.MOUSEBUTTONUP:
+            # Scrolling still works once the board is done.
+            if event.button == 2:
+                self.on_mbutton_up(event)
             if self._no_clicky:
                 return
             if event.button == 1:
                 self.on_lbutton_up(event)
-            elif event.button == 2:
-                self.on_mbutton_up(event)
             elif event.button == 3:
                 self.on_rbutton_up(event)
 
         elif event.type == pygame.MOUSEBUTTONDOWN:
+            if event.button == 2:
+                self.on_mbutton_down(event)
+            elif event.button in (4, 5):
+                self.on_wheel(event)
             if self._no_clicky:
                 return
             if event.button == 1:
                 self.on_lbutton_down(event)
-            elif event.button == 2:
-                self.on_mbutton_down(event)
             elif event.button == 3:
                 self.on_rbutton_down(event)
 
     def on_exit(self):
         self._is_running = False
 
+    def on_key_down(self, event):
+        if event.key == pygame.K_s and self.save_file:
+            self.save_to_pack(self.save_file)
+            log.info('Saved to %s', self.save_file)
+        elif event.key == pygame.K_n:
+            self.new_board()
+        elif event.key in (pygame.K_z, pygame.K_y) and \
+                event.mod & pygame.KMOD_CTRL:
+            if self._no_clicky:
+                return
+            if event.key == pygame.K_y or event.mod & pygame.KMOD_SHIFT:
+                self.redo()
+            else:
+                self.undo()
+        elif event.key in PAN_KEYS:
+            dx, dy = PAN_KEYS[event.key]
+            if event.mod & pygame.KMOD_SHIFT:
+                # A screenful at a time.
+                dx *= self.view_columns
+                dy *= self.view_rows
+            self.pan(dx, dy)
+
     def _get_node(self, pos):
+        """The node under the screen position pos, or None."""
         x, y = pos
-        node = (x / PIC_SIZE, y / PIC_SIZE)
+        if x >= PIC_SIZE * self.view_columns or y >= PIC_SIZE * self.view_rows:
+            return None
+        node = (x / PIC_SIZE + self.view_x, y / PIC_SIZE + self.view_y)
         if node not in self.board:
             return None
         return node
 
     def on_mouse_move(self, event):
-        active_node = self._get_node(event.pos)
-        for node, square in self.board.items():
-            square.is_highlighted = (node == active_node)
+        if self._drag_pos is not None:
+            self.drag_view(event.pos)
+        self.highlight(self._get_node(event.pos))
+
+    def highlight(self, active_node):
+        """Highlight the square at active_node (None for none)."""
+        if active_node == self.highlighted:
+            return
+        if self.highlighted is not None:
+            self.board[self.highlighted].is_highlighted = False
+            self._dirty.add(self.highlighted)
+        if active_node is not None:
+            self.board[active_node].is_highlighted = True
+            self._dirty.add(active_node)
+        self.highlighted = active_node
+
+    def on_user(self, event):
+        if event.type == CLOCK_EVENT and self.finish_time is not None:
+            # The clock has stopped; nothing to wake up for.
+            pygame.time.set_timer(CLOCK_EVENT, 0)
+
+    def on_mbutton_down(self, event):
+        self._drag_pos = event.pos
+
+    def on_mbutton_up(self, event):
+        self._drag_pos = None
+
+    def on_wheel(self, event):
+        step = WHEEL_STEP
+        if event.button == 4:
+            step = -step
+        if pygame.key.get_mods() & pygame.KMOD_SHIFT:
+            self.pan(step, 0)
+        else:
+            self.pan(0, step)
 
     def on_lbutton_down(self, event):
         node = self._get_node(event.pos)
         if node is not None:
-            self.board[node].rotate_right()
+            self.rotate_square(node)
             return
         self.solve_button.handle_click(event.pos)
 
     def on_rbutton_down(self, event):
         node = self._get_node(event.pos)
         if node is not None:
-            self.board[node].rotate_left()
+            self.rotate_square(node, clockwise=False)
             return
         self.solve_button.handle_click(event.pos)
 
+    #### Viewport ####
+    def reset_view(self):
+        """Fit the view to the board, scrolled to the top left."""
+        max_columns, max_rows = self.view_size
+        self.view_columns = min(len(self.xs), max_columns)
+        self.view_rows = min(len(self.ys), max_rows)
+        self.view_x = 0
+        self.view_y = 0
+        PipeSegment.view_origin = (0, 0)
+        self._redraw_all = True
+
+    def pan(self, dx, dy):
+        """Scroll the view dx columns and dy rows, as far as the board goes."""
+        view_x = max(0, min(self.view_x + dx,
+                            len(self.xs) - self.view_columns))
+        view_y = max(0, min(self.view_y + dy,
+                            len(self.ys) - self.view_rows))
+        if (view_x, view_y) == (self.view_x, self.view_y):
+            return
+        self.view_x = view_x
+        self.view_y = view_y
+        PipeSegment.view_origin = (view_x, view_y)
+        self._redraw_all = True
+        # Whatever is under the mouse now is a different square.
+        self.highlight(self._get_node(pygame.mouse.get_pos()))
+
+    def drag_view(self, pos):
+        """Drag the board along with the mouse, a whole square at a time."""
+        drag_x, drag_y = self._drag_pos
+        x, y = pos
+        dx = int((drag_x - x) / float(PIC_SIZE))
+        dy = int((drag_y - y) / float(PIC_SIZE))
+        if dx or dy:
+            self._drag_pos = (drag_x - PIC_SIZE * dx, drag_y - PIC_SIZE * dy)
+            self.pan(dx, dy)
+
+    def is_visible(self, node):
+        x, y = node
+        return (self.view_x <= x < self.view_x + self.view_columns and
+                self.view_y <= y < self.view_y + self.view_rows)
+
+    def iter_visible(self):
+        """Yields the squares in view, row by row."""
+        for y in range(self.view_y, self.view_y + self.view_rows):
+            for x in range(self.view_x, self.view_x + self.view_columns):
+                yield self.board[(x, y)]
+
     #### Loop ####
     def on_loop(self):
         """Modifies the environment based on signals from events."""
-        self.mark_attached()
+        self.collect_known()
         self.is_complete()
 
-    def mark_attached(self):
-        for square in self.board.values():
-            square.is_attached = False
-
-        attached_nodes = deque()
-        attached_nodes.append(self.source)
-        while attached_nodes:
-            node = attached_nodes.pop()
-            square = self.board.get(node)
-            if square is None:
-                continue
-            if not square.is_attached:
-                for potential in square.get_possible_connected_nodes():
-                    p_square = self.board.get(potential)
-                    if p_square is None:
-                        continue
-                    if p_square.is_connected_to(node):
-                        attached_nodes.append(potential)
-            square.is_attached = True
+    def on_square_changed(self, node):
+        self._dirty.add(node)
+
+    def on_board_changed(self):
+        self._redraw_all = True
 
     def is_complete(self):
-        for square in self.board.values():
-            if not square.is_attached:
-                return False
+        if not pipeslib.Board.is_complete(self):
+            return False
         self._no_clicky = True
         if self.finish_time is None:
             self.finish_time = datetime.datetime.now()
@@ -621,11 +567,14 @@ class PipesBoard(cevent.CEvent):
 
     #### Render ####
     def on_render(self):
+        if self.dirty_rendering:
+            self.on_render_dirty()
+            return
+
         #self.screen.fill((1, 1, 1))
         self.screen.fill((54, 54, 54))
-        for y in self.ys:
-            for x in self.xs:
-                self.board[(x, y)].on_render()
+        for square in self.iter_visible():
+            square.on_render()
 
         self.solve_button.on_render()
 
@@ -634,6 +583,49 @@ class PipesBoard(cevent.CEvent):
         self.display_time()
         pygame.display.flip()
 
+    def on_render_dirty(self):
+        """
+        Redraw only the squares that changed, plus the status area when its
+        text changes, and push just those rectangles to the display.
+        """
+        if self._redraw_all:
+            self._redraw_all = False
+            self._dirty.clear()
+            self._status_text = None
+            self.screen.fill((54, 54, 54))
+            for square in self.iter_visible():
+                square.on_render()
+            rects = [self.screen.get_rect()]
+        else:
+            rects = []
+            for node in self._dirty:
+                if not self.is_visible(node):
+                    continue
+                x, y = node
+                rect = pygame.Rect(PIC_SIZE * (x - self.view_x),
+                                   PIC_SIZE * (y - self.view_y),
+                                   PIC_SIZE, PIC_SIZE)
+                self.screen.fill((54, 54, 54), rect)
+                self.board[node].on_render()
+                rects.append(rect)
+            self._dirty.clear()
+
+        status_text = (self._no_clicky, self.get_time_text())
+        if status_text != self._status_text:
+            self._status_text = status_text
+            status_rect = self.screen.get_rect()
+            status_rect.top = PIC_SIZE * self.view_rows
+            status_rect.height -= status_rect.top
+            self.screen.fill((54, 54, 54), status_rect)
+            self.solve_button.on_render()
+            if self._no_clicky:
+                self.display_win()
+            self.display_time()
+            rects.append(status_rect)
+
+        if rects:
+            pygame.display.update(rects)
+
     def display_win(self):
         text = self.font.render("OMG Kittens!", True, (255, 255, 0))
         text_rect = text.get_rect()
@@ -641,14 +633,16 @@ class PipesBoard(cevent.CEvent):
         text_rect.bottom = self.screen.get_rect().bottom - PIC_SIZE
         self.screen.blit(text, text_rect)
 
-    def display_time(self):
+    def get_time_text(self):
         if self.finish_time is None:
             delta = datetime.datetime.now() - self.start_time
         else:
             delta = self.finish_time - self.start_time
 
-        text = str(delta.seconds) + ' sec'
-        text = self.font.render(text, True, (255, 255, 0))
+        return str(delta.seconds) + ' sec'
+
+    def display_time(self):
+        text = self.font.render(self.get_time_text(), True, (255, 255, 0))
         text_rect = text.get_rect()
         text_rect.centerx = self.screen.get_rect().centerx
         text_rect.bottom = self.screen.get_rect().bottom
@@ -663,50 +657,56 @@ class PipesBoard(cevent.CEvent):
     def on_execute(self):
         """Main Execution loop."""
         self.on_init()
+        if self.event_driven:
+            pygame.time.set_timer(CLOCK_EVENT, CLOCK_INTERVAL)
 
         while self._is_running:
+            if self.event_driven:
+                # Sleep until there's an event, then take every one that's
+                # waiting so a burst of them is only rendered once.
+                self.on_event(pygame.event.wait())
             for event in pygame.event.get():
                 self.on_event(event)
             self.on_loop()
             self.on_render()
-
+            if self.fps:
+                self.clock.tick(self.fps)
+
+        if self.event_driven:
+            pygame.time.set_timer(CLOCK_EVENT, 0)
+        if self.background_solver is not None:
+            self.background_solver.cancel()
+            self.background_solver.join(1)
         self.on_cleanup()
 
     #### Solving Stuff ####
     def solve_piece(self):
-        print 'You cheater!'
-
-        for node in self.ignored_solved:
-            k_square = self.solver.board[node]
-            known_connection = k_square.get_connection()
-            b_square = self.board[node]
-            if known_connection != b_square.get_connection():
-                self.ignored_solved.remove(node)
-                b_square.connections = [known_connection]
-                b_square.cursor = 0
-                print 'setting %s' % (node, )
-                return
-
-        for node, k_square in self.solved:
-            known_connection = k_square.get_connection()
-            b_square = self.board[node]
-            if known_connection == b_square.get_connection():
-                self.ignored_solved.add(node)
-                continue
-
-            b_square.connections = [known_connection]
-            b_square.cursor = 0
-            print 'setting %s' % (node, )
+        log.info('You cheater!')
+
+        self.collect_known()
+        hint = self.pop_hint()
+        if hint is None:
+            if self.background_solver.done:
+                log.info('No pieces are known that are not already in '
+                         'place.')
+            else:
+                log.info('Still working on it; try again in a moment.')
             return
 
-        print 'No pieces are known that are not already in place.'
-        return
+        node, connection = hint
+        self.fix_square(node, connection)
+        log.info('setting %s', node)
 
 
-def launch_board(columns=16, rows=None):
+def launch_board(columns=16, rows=None, generator='kruskal',
+                 dirty_rendering=True, fps=30, pack_file=None, puzzle_index=0,
+                 save_file=None, seed=None, view_size=None,
+                 event_driven=True, solver_process=False):
     if rows is None:
         rows = columns
-    pipes = PipesBoard(columns, rows)
+    pipes = PipesBoard(columns, rows, generator, dirty_rendering, fps,
+                       pack_file, puzzle_index, save_file, seed, view_size,
+                       event_driven, solver_process)
     pipes.on_execute()
 
 
@@ -714,15 +714,85 @@ def get_command_line_options():
     global PICS_DIR
 
     parser = optparse.OptionParser()
+    parser.add_option('-v', '--verbose', dest='verbosity',
+                      help='Log more (the board, the solver\'s progress).',
+                      action='store_const', const=logging.DEBUG,
+                      default=logging.INFO)
+    parser.add_option('-q', '--quiet', dest='verbosity',
+                      help='Only log warnings and errors.',
+                      action='store_const', const=logging.WARNING)
     parser.add_option('-t', '--tile-directory', dest='tile_directory',
                       help='The directory to find the tile-pngs in.',
                       metavar='DIR', default=PICS_DIR)
+    parser.add_option('--build-atlas', dest='build_atlas',
+                      help='Pack the tile-pngs into a single atlas and exit.',
+                      action='store_true', default=False)
     parser.add_option('-r', '--rows', dest='rows',
                       help='The number of rows on the pipes board.',
                       metavar='NUM', default=None)
     parser.add_option('-c', '--columns', dest='columns',
                       help='The number of columns on the pipes board.',
                       metavar='NUM', default=16)
+    parser.add_option('-g', '--generator', dest='generator',
+                      help='The spanning tree algorithm used to generate '
+                           'the board: kruskal, prim, random or wilson.',
+                      metavar='ALGORITHM', default='kruskal',
+                      choices=['kruskal', 'prim', 'random', 'wilson'])
+    parser.add_option('--seed', dest='seed', type='long',
+                      help='Generate the board from this seed, to get the '
+                           'same board again (with --batch, puzzle i gets '
+                           'seed NUM + i).',
+                      metavar='NUM', default=None)
+    parser.add_option('-f', '--fps', dest='fps', type='int',
+                      help='The maximum frames per second (0 for no limit).',
+                      metavar='NUM', default=30)
+    parser.add_option('--view', dest='view_size', type='int', nargs=2,
+                      help='The most columns and rows shown at once; '
+                           'bigger boards scroll (default: %d %d).'
+                           % MAX_VIEW_SIZE,
+                      metavar='COLUMNS ROWS', default=MAX_VIEW_SIZE)
+    parser.add_option('--polling', dest='event_driven',
+                      help='Run the main loop flat out, polling for events, '
+                           'instead of waiting for them.',
+                      action='store_false', default=True)
+    parser.add_option('--solver-process', dest='solver_process',
+                      help='Work out hints in a separate process instead of '
+                           'a thread.',
+                      action='store_true', default=False)
+    parser.add_option('--full-redraw', dest='dirty_rendering',
+                      help='Redraw the whole board every frame.',
+                      action='store_false', default=True)
+    parser.add_option('--pack', dest='pack_file',
+                      help='Play a puzzle from a pack file instead of '
+                           'generating one.',
+                      metavar='FILE', default=None)
+    parser.add_option('-n', '--puzzle', dest='puzzle_index', type='int',
+                      help='Which puzzle in the pack to play.',
+                      metavar='NUM', default=0)
+    parser.add_option('-s', '--save', dest='save_file',
+                      help='The pack file to add the board to when s is '
+                           'pressed.',
+                      metavar='FILE', default='saved.pack')
+
+    batch = optparse.OptionGroup(parser, 'Batch generation',
+                                 'Generate puzzles without playing them.')
+    batch.add_option('-b', '--batch', dest='batch', type='int',
+                     help='Generate NUM puzzles and exit.',
+                     metavar='NUM', default=None)
+    batch.add_option('-o', '--output', dest='output',
+                     help='The file to write the puzzles to; a binary pack '
+                          'if it ends in .pack.',
+                     metavar='FILE', default='puzzles.pack')
+    batch.add_option('-p', '--processes', dest='processes', type='int',
+                     help='The number of worker processes '
+                          '(default: one per CPU).',
+                     metavar='NUM', default=None)
+    batch.add_option('--verify', dest='verify',
+                     help='Only keep puzzles the solver can finish, with '
+                          'propagation alone or with search too.',
+                     metavar='HOW', default=None,
+                     choices=['propagation', 'search'])
+    parser.add_option_group(batch)
 
     opts, args = parser.parse_args()
 
@@ -736,7 +806,22 @@ def get_command_line_options():
 
 def main():
     opts, args = get_command_line_options()
-    launch_board(opts.columns, opts.rows)
+    logging.basicConfig(level=opts.verbosity, format='%(message)s')
+    if opts.build_atlas:
+        build_atlas()
+        print 'Wrote %s' % get_atlas_file()
+        return
+    if opts.batch is not None:
+        written = pipeslib.generate_batch(opts.batch, opts.columns, opts.rows,
+                                          opts.output, opts.generator,
+                                          opts.verify, opts.processes,
+                                          opts.seed)
+        print 'Wrote %d puzzles to %s' % (written, opts.output)
+        return
+    launch_board(opts.columns, opts.rows, opts.generator,
+                 opts.dirty_rendering, opts.fps, opts.pack_file,
+                 opts.puzzle_index, opts.save_file, opts.seed,
+                 opts.view_size, opts.event_driven, opts.solver_process)
 
 
 if __name__ == '__main__':
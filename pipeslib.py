@@ -0,0 +1,2052 @@
+#!/usr/bin/env python
+
+"""
+The game of pipes without a display: boards, generation, solving and
+connectivity. Nothing here imports pygame.
+"""
+
+import logging
+import multiprocessing
+import Queue
+import random
+import threading
+import time
+from array import array
+from collections import deque
+
+import graphlib
+import packlib
+
+# numpy takes longer to import than the rest of the core, and only
+# vectorized solving needs it, so it's imported then; see _load_numpy.
+numpy = None
+
+log = logging.getLogger('pipeslib')
+
+
+class PipeSegment(object):
+    """A representation of a segfmfent on the Pipes board."""
+
+    min_x = 0
+    min_y = 0
+    max_x = 0
+    max_y = 0
+
+    initial_end_sets = {
+        'end-cap': tuple(map(frozenset, [[0],
+                                         [1],
+                                         [2],
+                                         [3]])),
+        'angle': tuple(map(frozenset, [[0, 1],
+                                       [1, 2],
+                                       [2, 3],
+                                       [3, 0]])),
+        'straight': tuple(map(frozenset, [[0, 2],
+                                          [1, 3]])),
+        'tee': tuple(map(frozenset, [[0, 1, 2],
+                                     [1, 2, 3],
+                                     [2, 3, 0],
+                                     [3, 0, 1]])),
+        'cross': tuple(map(frozenset, [[0, 1, 2, 3]])),
+    }
+
+    set_chars = {
+        # End-Caps
+        frozenset([0]): u'\u2579',
+        frozenset([1]): u'\u257a',
+        frozenset([2]): u'\u257b',
+        frozenset([3]): u'\u2578',
+        # Angles
+        frozenset([0, 1]): u'\u255a',
+        frozenset([1, 2]): u'\u2554',
+        frozenset([2, 3]): u'\u2557',
+        frozenset([3, 0]): u'\u255d',
+        # Straights
+        frozenset([0, 2]): u'\u2551',
+        frozenset([1, 3]): u'\u2550',
+        # T's
+        frozenset([0, 1, 2]): u'\u2560',
+        frozenset([1, 2, 3]): u'\u2566',
+        frozenset([2, 3, 0]): u'\u2563',
+        frozenset([3, 0, 1]): u'\u2569',
+        # Crosses
+        frozenset([0, 1, 2, 3]): u'\u256c',
+    }
+
+    def __init__(self, initial_connections, node):
+        """
+        Constructor for a pipe segment. seg_type can be:
+        'end-cap', 'angle', 'straight', 'tee', or 'cross'.
+        """
+        for connections in self.initial_end_sets.values():
+            if initial_connections in connections:
+                self.connections = list(connections)
+                break
+        else:
+            msg = 'Invalid initial_connections: %r' % initial_connections
+            raise ValueError(msg)
+        self.cursor = self.connections.index(initial_connections)
+        self.node = node
+        x, y = node
+        self.min_x = min(self.min_x, x)
+        self.min_y = min(self.min_y, y)
+        self.max_x = max(self.max_x, x)
+        self.max_y = max(self.max_y, y)
+
+        self.is_attached = False
+
+    def on_init(self, rng=random):
+        """
+        Jumble the square such that it is random,
+        ...but different than initialized.
+        rng is the random.Random to draw from; by default, the global one.
+        """
+        if self.is_set():
+            return
+
+        possible_cursors = range(len(self.connections))
+        possible_cursors.remove(self.cursor)
+        self.cursor = rng.choice(possible_cursors)
+
+    def rotate_right(self):
+        self.cursor += 1
+        if self.cursor >= len(self.connections):
+            self.cursor = 0
+
+    def rotate_left(self):
+        self.cursor -= 1
+        if self.cursor < 0:
+            self.cursor = len(self.connections) - 1
+
+    def attached_to_source(self):
+        """Returns True if self is attached to the source."""
+        return self.is_attached
+
+    def is_set(self):
+        """Returns True if the segment only has one possibility."""
+        return 1 == len(self.connections)
+
+    def get_connection(self):
+        return self.connections[self.cursor]
+
+    def __unicode__(self):
+        """A unicode representation of a pipe segment."""
+        return self.set_chars[self.connections[self.cursor]]
+
+    def clone(self):
+        """
+        A copy of the square, without running the constructor again: only
+        the connections list is copied, everything else is shared.
+        """
+        new_copy = object.__new__(type(self))
+        new_copy.__dict__.update(self.__dict__)
+        new_copy.connections = list(self.connections)
+        return new_copy
+
+    def get_neighbors(self):
+        """
+        Returns all nodes next to this node.
+        NOTE: This includes squares off the board.
+        """
+
+        x, y = self.node
+        neighbors = [
+            (x, y - 1),
+            (x + 1, y),
+            (x, y + 1),
+            (x - 1, y),
+        ]
+        return neighbors
+
+    def get_possible_connected_nodes(self):
+        """
+        Returns all possible node-positions that could connect to this node.
+        NOTE: This includes squares off the board.
+        """
+        x, y = self.node
+        connected_nodes = deque()
+        for direction in self.get_connection():
+            if direction == 0:
+                connected_nodes.append((x, y - 1))
+            elif direction == 1:
+                connected_nodes.append((x + 1, y))
+            elif direction == 2:
+                connected_nodes.append((x, y + 1))
+            elif direction == 3:
+                connected_nodes.append((x - 1, y))
+        return connected_nodes
+
+    def get_links(self, pos):
+        sx, sy = self.node
+        rx, ry = pos
+        dx = sx - rx
+        dy = sy - ry
+
+        link_map = {
+            (0, 1): (0, 2),
+            (0, -1): (2, 0),
+            (1, 0): (3, 1),
+            (-1, 0): (1, 3),
+        }
+
+        return link_map.get((dx, dy))
+
+    def is_connected_to(self, pos):
+        links = self.get_links(pos)
+        my_link = links[0]
+        return my_link in self.get_connection()
+
+    def delete_connection(self, bad_option):
+        """Delete any connectfion that contains bad_option."""
+        option = self.get_connection()
+        for connection in list(self.connections):
+            if bad_option in connection:
+                self.connections.remove(connection)
+
+        self.cursor = 0
+        if option in self.connections:
+            self.cursor = self.connections.index(option)
+
+    def is_a_nub(self):
+        """
+        Returns true if this square will only connect to one other square.
+        """
+        return len(self.get_connection()) == 1
+
+    def learn_from_neighbor(self, n_square, observer=None):
+        """
+        Returns True if self is modified based on data within neighbor.
+        observer, a SolverObserver, is told about every rule that fires.
+        """
+        old_connections = list(self.connections)
+        cursor_connection = self.get_connection()
+        my_link, his_link = self.get_links(n_square.node)
+        his_connections = n_square.connections
+
+        # Check positives first.
+        link_missing = False
+        for his_connection in his_connections:
+            link_missing |= (his_link not in his_connection)
+        if not link_missing:
+            # Our link MUST be used.
+            removed = [my_connection for my_connection in self.connections
+                       if my_link not in my_connection]
+            for my_connection in removed:
+                self.connections.remove(my_connection)
+            if observer is not None and removed:
+                observer.on_prune('positive', self.node, n_square.node,
+                                  removed)
+
+        if not self.connections:
+            # A contradiction; there's nothing left to learn.
+            self.cursor = 0
+            return True
+
+        # Check negatives next.
+        link_present = False
+        for his_connection in his_connections:
+            link_present |= (his_link in his_connection)
+        if not link_present or (self.is_a_nub() and n_square.is_a_nub()):
+            # Our link MUST NOT be used.
+            removed = [my_connection for my_connection in self.connections
+                       if my_link in my_connection]
+            for my_connection in removed:
+                self.connections.remove(my_connection)
+            if observer is not None and removed:
+                rule = 'negative' if not link_present else 'nub-nub'
+                observer.on_prune(rule, self.node, n_square.node, removed)
+
+        # If we didn't modify anything, we're done.
+        if self.connections == old_connections:
+            return False
+
+        # Make sure our cursor isn't pointing to nothing.
+        self.cursor = 0
+        if cursor_connection in self.connections:
+            self.cursor = self.connections.index(cursor_connection)
+        return True
+
+
+# END_SET_OF[connection]: The PipeSegment.initial_end_sets tuple (every
+# rotation of a piece) that connection is in.
+END_SET_OF = dict((connection, end_set)
+                  for end_set in PipeSegment.initial_end_sets.values()
+                  for connection in end_set)
+
+
+class BoardSnapshot(object):
+    """
+    An immutable sequence of a value per square, row by row.
+
+    It's a persistent vector: a tree of tuples, SNAPSHOT_WIDTH wide.
+    set returns a new snapshot that shares everything with this one but
+    the path to the changed value, so keeping many snapshots that differ
+    in a few squares costs little, and diff only looks where two
+    snapshots don't share.
+    """
+
+    __slots__ = ('_root', '_shift', '_size')
+
+    def __init__(self, values=(), _tree=None):
+        if _tree is not None:
+            self._root, self._shift, self._size = _tree
+            return
+
+        level = [tuple(chunk) for chunk in _chunks(values, SNAPSHOT_WIDTH)]
+        self._size = sum(len(leaf) for leaf in level)
+        self._shift = 0
+        while len(level) > 1:
+            level = [tuple(chunk) for chunk in _chunks(level, SNAPSHOT_WIDTH)]
+            self._shift += SNAPSHOT_BITS
+        self._root = level[0] if level else ()
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._size:
+            raise IndexError('Snapshot index out of range: %r' % (index, ))
+        node = self._root
+        shift = self._shift
+        while shift:
+            node = node[(index >> shift) & SNAPSHOT_MASK]
+            shift -= SNAPSHOT_BITS
+        return node[index & SNAPSHOT_MASK]
+
+    def __iter__(self):
+        stack = [(self._root, self._shift)]
+        while stack:
+            node, shift = stack.pop()
+            if not shift:
+                for value in node:
+                    yield value
+                continue
+            for child in reversed(node):
+                stack.append((child, shift - SNAPSHOT_BITS))
+
+    def set(self, index, value):
+        """A snapshot with value at index, and everything else the same."""
+        if not 0 <= index < self._size:
+            raise IndexError('Snapshot index out of range: %r' % (index, ))
+        if self[index] is value:
+            return self
+        root = self._set(self._root, self._shift, index, value)
+        return BoardSnapshot(_tree=(root, self._shift, self._size))
+
+    def _set(self, node, shift, index, value):
+        slot = (index >> shift) & SNAPSHOT_MASK
+        if shift:
+            value = self._set(node[slot], shift - SNAPSHOT_BITS, index, value)
+        return node[:slot] + (value, ) + node[slot + 1:]
+
+    def diff(self, other):
+        """
+        Yields the indexes whose values differ between this snapshot and
+        other (of the same length). Shared parts aren't looked at.
+        """
+        stack = [(self._root, other._root, self._shift, 0)]
+        while stack:
+            node, o_node, shift, base = stack.pop()
+            if node is o_node:
+                continue
+            if not shift:
+                for slot, value in enumerate(node):
+                    o_value = o_node[slot]
+                    if value is not o_value and value != o_value:
+                        yield base + slot
+                continue
+            for slot, child in enumerate(node):
+                stack.append((child, o_node[slot], shift - SNAPSHOT_BITS,
+                              base + (slot << shift)))
+
+
+SNAPSHOT_BITS = 5
+SNAPSHOT_WIDTH = 1 << SNAPSHOT_BITS
+SNAPSHOT_MASK = SNAPSHOT_WIDTH - 1
+
+
+def _chunks(items, size):
+    """Yields lists of size items at a time (the last may be shorter)."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class SearchLimitReached(RuntimeError):
+    """The solver's search ran out of nodes or time."""
+    pass
+
+
+class SolverObserver(object):
+    """
+    Is told what a Solver deduces, as it deduces it. Every method does
+    nothing; subclass and override the ones you want.
+    """
+
+    def on_start(self, solver):
+        """solver is about to start solving."""
+        pass
+
+    def on_finish(self, solver):
+        """solver has deduced all it can."""
+        pass
+
+    def on_phase_start(self, phase):
+        """phase ('edges', 'propagation' or 'search') is starting."""
+        pass
+
+    def on_phase_end(self, phase):
+        """phase has finished."""
+        pass
+
+    def on_pass(self, number):
+        """
+        Pass number (from 1) over the board is starting. For 'worklist'
+        propagation, a pass is the squares queued by the one before it.
+        """
+        pass
+
+    def on_learn(self, node, n_node, modified):
+        """The square at node looked at n_node; modified if it changed."""
+        pass
+
+    def on_solved(self, node):
+        """The square at node is now set."""
+        pass
+
+    def on_prune(self, rule, node, n_node, removed):
+        """
+        rule removed the connections in removed from the square at node.
+        rule is one of:
+        'edge': removed links pointing off the board (n_node is None).
+        'positive': n_node must link to node, so node must link back.
+        'negative': n_node can't link to node, so node can't link back.
+        'nub-nub': node and n_node are both nubs, so can't link each other.
+        """
+        pass
+
+
+class SolverMetrics(SolverObserver):
+    """
+    Counts and times what a Solver does:
+    passes: Passes over the board.
+    learn_calls: Times a square looked at a neighbor.
+    pruned: Connections removed, by rule (see SolverObserver.on_prune).
+    phase_times: Seconds spent in each phase.
+    solved_curve: (seconds since the start, squares set) every time
+      another square is set, starting with the ones set from the start.
+
+    Times include whatever the caller does between the nodes it's handed,
+    so run the solver to the end in one go for meaningful times.
+    """
+
+    def __init__(self):
+        self.passes = 0
+        self.learn_calls = 0
+        self.pruned = {}
+        self.phase_times = {}
+        self.solved_curve = []
+        self._solved = set()
+        self._start_time = None
+        self._phase_start_time = None
+
+    def on_start(self, solver):
+        self._start_time = time.time()
+        self._solved.update(solver.iter_set())
+        self.solved_curve.append((0.0, len(self._solved)))
+
+    def on_phase_start(self, phase):
+        self._phase_start_time = time.time()
+
+    def on_phase_end(self, phase):
+        elapsed = time.time() - self._phase_start_time
+        self.phase_times[phase] = self.phase_times.get(phase, 0.0) + elapsed
+
+    def on_pass(self, number):
+        self.passes += 1
+
+    def on_learn(self, node, n_node, modified):
+        self.learn_calls += 1
+
+    def on_prune(self, rule, node, n_node, removed):
+        self.pruned[rule] = self.pruned.get(rule, 0) + len(removed)
+
+    def on_solved(self, node):
+        if node in self._solved:
+            return
+        self._solved.add(node)
+        self.solved_curve.append((time.time() - self._start_time,
+                                  len(self._solved)))
+
+    def __unicode__(self):
+        """A few lines summarizing the metrics."""
+        lines = [u'passes: %d' % self.passes,
+                 u'learn_from_neighbor calls: %d' % self.learn_calls]
+        for rule in sorted(self.pruned):
+            lines.append(u'pruned by %s: %d' % (rule, self.pruned[rule]))
+        for phase in sorted(self.phase_times):
+            lines.append(u'%s: %.4f sec' % (phase, self.phase_times[phase]))
+        if self.solved_curve:
+            seconds, solved = self.solved_curve[-1]
+            lines.append(u'solved: %d squares after %.4f sec'
+                         % (solved, seconds))
+        return u'\n'.join(lines)
+
+
+class SolveTrace(SolverObserver):
+    """
+    Records every step a Solver takes as (rule, node, n_node, removed), so
+    the same deductions can be saved, compared and replayed later.
+    """
+
+    def __init__(self, steps=()):
+        self.steps = list(steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __eq__(self, other):
+        return isinstance(other, SolveTrace) and self.steps == other.steps
+
+    def __ne__(self, other):
+        return not self == other
+
+    def on_prune(self, rule, node, n_node, removed):
+        self.steps.append((rule, node, n_node,
+                           tuple(sorted(connection_mask(connection)
+                                        for connection in removed))))
+
+    def replay(self, board):
+        """
+        Apply the recorded steps to a copy of board (a dict of squares, as
+        Solver takes), checking that each of them still can be.
+        Returns the copy; raises ValueError at the first step that can't.
+        """
+        squares = {}
+        for node, square in board.items():
+            squares[node] = square.clone()
+            squares[node].cursor = 0
+
+        for number, (rule, node, n_node, removed) in enumerate(self.steps):
+            square = squares.get(node)
+            if square is None:
+                raise ValueError('Step %d: %r is not on the board.'
+                                 % (number, node))
+            remaining = [connection for connection in square.connections
+                         if connection_mask(connection) not in removed]
+            if len(square.connections) - len(remaining) != len(removed):
+                raise ValueError('Step %d: %s rule on %r no longer applies.'
+                                 % (number, rule, node))
+            square.connections = remaining
+            square.cursor = 0
+        return squares
+
+    def save(self, path):
+        """Write the steps to path, one per line."""
+        with open(path, 'w') as trace_file:
+            for rule, node, n_node, removed in self.steps:
+                if n_node is None:
+                    n_node = ('-', '-')
+                fields = (rule,) + node + n_node + removed
+                trace_file.write(' '.join(str(field) for field in fields))
+                trace_file.write('\n')
+
+    @classmethod
+    def load(cls, path):
+        """Read steps written by save."""
+        steps = []
+        with open(path) as trace_file:
+            for line in trace_file:
+                fields = line.split()
+                rule = fields[0]
+                node = (int(fields[1]), int(fields[2]))
+                n_node = None
+                if fields[3] != '-':
+                    n_node = (int(fields[3]), int(fields[4]))
+                removed = tuple(int(field) for field in fields[5:])
+                steps.append((rule, node, n_node, removed))
+        return cls(steps)
+
+
+class Solver(object):
+    """
+    Deduces the solution of a board from local constraints.
+
+    propagation can be:
+    'worklist': Only re-examine the neighbors of squares that changed.
+    'sweep': Re-examine every square until a whole pass changes nothing.
+    'bitmask': Worklist propagation on a compact BitBoard copy of the board.
+    'vectorized': Whole-board NumPy sweeps on a BitBoard copy of the board.
+
+    board is a dict of squares keyed by node, or a BitBoard (such as
+    BitBoard.from_masks makes). A dict's squares aren't copied up front:
+    the solver shares them, and copies each one only when it first works
+    on it (see _own). So making a Solver costs next to nothing, and
+    squares it never works on, such as those set from the start, are
+    never copied.
+
+    The 'bitmask' and 'vectorized' modes keep nothing but the BitBoard:
+    there are no squares (self.board is None) unless a search needs them,
+    so use is_set, get_connection and iter_connections rather than
+    self.board.
+
+    If search is True, whatever propagation can't finish is handed to
+    solve_search, bounded by node_budget and timeout (in seconds).
+
+    observer, a SolverObserver (such as a SolveTrace or SolverMetrics), is
+    told about every deduction. Only 'worklist' and 'sweep' propagation
+    report passes, learning and pruning; the search's own guesses and
+    backtracking aren't reported. Without an observer none of this costs
+    anything beyond a check for None.
+    """
+
+    def __init__(self, board, propagation='worklist', search=False,
+                 node_budget=None, timeout=None, observer=None):
+        if propagation not in ('worklist', 'sweep', 'bitmask', 'vectorized'):
+            raise ValueError('Invalid propagation: %r' % propagation)
+        self.propagation = propagation
+        self.observer = observer
+        self.search = search
+        self.node_budget = node_budget
+        self.timeout = timeout
+        self.nodes_explored = 0
+        # board: The squares, by node; bits: The BitBoard. Only one is used.
+        # _shared: The nodes whose squares in board are still the caller's.
+        self.board = None
+        self.bits = None
+        self._shared = set()
+        # num_solved: How many squares are set, kept up as they're set.
+        self.num_solved = 0
+        # The search's BoardSnapshot, and the node of each of its indexes.
+        self._snapshot = None
+        self._snapshot_nodes = None
+
+        self.min_x = 0
+        self.min_y = 0
+        self.max_x = 0
+        self.max_y = 0
+
+        if propagation in ('bitmask', 'vectorized'):
+            if isinstance(board, BitBoard):
+                self._use_bits(board.copy())
+            else:
+                self._use_bits(BitBoard.from_board(board))
+        elif isinstance(board, BitBoard):
+            # Made just for us; there's nothing to copy.
+            self._use_squares(board.squares())
+        else:
+            self._use_squares(dict(board))
+            self._shared = set(board)
+
+    def _use_squares(self, squares):
+        """Solve on squares, a dict of the solver's own PipeSegments."""
+        self.board = squares
+        self.bits = None
+        self._shared = set()
+        # One pass, with locals: this is most of what making a Solver costs.
+        num_solved = 0
+        min_x = min_y = max_x = max_y = 0
+        for (x, y), square in squares.iteritems():
+            if square.is_set():
+                num_solved += 1
+            if x < min_x:
+                min_x = x
+            elif x > max_x:
+                max_x = x
+            if y < min_y:
+                min_y = y
+            elif y > max_y:
+                max_y = y
+        self.num_solved = num_solved
+        self.min_x = min_x
+        self.min_y = min_y
+        self.max_x = max_x
+        self.max_y = max_y
+
+    def _use_bits(self, bits):
+        """Solve on bits, the solver's own BitBoard."""
+        self.board = None
+        self.bits = bits
+        self.max_x = bits.width - 1
+        self.max_y = bits.height - 1
+        self.num_solved = sum(1 for index in range(len(bits))
+                              if self._bit_is_set(index))
+
+    def _own(self, node):
+        """
+        The square at node, first replaced with the solver's own copy if
+        it's still shared with the caller. Call before changing a square.
+        """
+        square = self.board[node]
+        if node in self._shared:
+            self._shared.remove(node)
+            square = square.clone()
+            square.cursor = 0
+            self.board[node] = square
+        return square
+
+    def _bit_is_set(self, index):
+        # Unlike BitBoard.is_set, a square with no candidates isn't set.
+        candidates = self.bits.candidates[index]
+        return candidates != 0 and candidates & (candidates - 1) == 0
+
+    def __len__(self):
+        """The number of squares."""
+        if self.board is None:
+            return len(self.bits)
+        return len(self.board)
+
+    def is_set(self, node):
+        """Returns True if the square at node only has one possibility."""
+        if self.board is None:
+            return self._bit_is_set(self.bits.index(node))
+        return self.board[node].is_set()
+
+    def get_connection(self, node):
+        """The connection of the square at node (once it's set)."""
+        if self.board is None:
+            return MASK_CONNECTIONS[self.bits.connections[
+                self.bits.index(node)]]
+        return self.board[node].get_connection()
+
+    def iter_set(self):
+        """Yields the node of every square set so far."""
+        if self.board is None:
+            for index in range(len(self.bits)):
+                if self._bit_is_set(index):
+                    yield self.bits.node(index)
+            return
+        for node, square in self.board.items():
+            if square.is_set():
+                yield node
+
+    def is_solved(self):
+        """Returns True if every square is set."""
+        return self.num_solved == len(self)
+
+    def iter_solved(self):
+        """
+        Yields (node, square) for every square set, as it's set. Only the
+        'worklist' and 'sweep' modes have squares; see iter_connections.
+        Squares set from the start may be the caller's own.
+        """
+        if self.bits is not None:
+            raise ValueError('%r propagation has no squares; use '
+                             'iter_connections.' % self.propagation)
+        for node in self.iter_altered():
+            square = self.board[node]
+            if square.is_set():
+                yield (node, square)
+
+    def iter_connections(self):
+        """Yields (node, connection) for every square set, as it's set."""
+        for node in self.iter_altered():
+            if self.is_set(node):
+                yield (node, self.get_connection(node))
+
+    def iter_altered(self):
+        observer = self.observer
+        if observer is not None:
+            observer.on_start(self)
+
+        if self.propagation in ('bitmask', 'vectorized'):
+            propagate = self._observe_phase('propagation',
+                                            self.solve_bitmask())
+        else:
+            propagate = self.solve_objects()
+        for node in propagate:
+            yield node
+
+        if self.search:
+            for node in self._observe_phase('search', self.iter_search()):
+                yield node
+
+        if observer is not None:
+            observer.on_finish(self)
+
+    def iter_search(self):
+        """
+        solve_search, yielding the squares it set, if it succeeds. There's
+        nothing to search for once propagation has left a square with no
+        connections: the board has no solution.
+        """
+        if self.board is None:
+            if self.is_solved() or not all(self.bits.candidates):
+                return
+            # The search works on squares, so only now are they made.
+            self._use_squares(self.bits.squares())
+        unsolved = [node for node, square in self.board.items()
+                    if not square.is_set()]
+        if not unsolved or not all(square.connections
+                                   for square in self.board.itervalues()):
+            return
+        try:
+            found = self.solve_search(self.node_budget, self.timeout)
+        except SearchLimitReached:
+            return
+        if found:
+            for node in unsolved:
+                yield node
+
+    def _observe_phase(self, phase, nodes):
+        """
+        Tell the observer (if any) when phase starts and ends, and which
+        squares it sets; nodes are the squares the phase altered.
+        """
+        observer = self.observer
+        if observer is None:
+            return nodes
+        return self._iter_observed_phase(observer, phase, nodes)
+
+    def _iter_observed_phase(self, observer, phase, nodes):
+        observer.on_phase_start(phase)
+        for node in nodes:
+            if self.is_set(node):
+                observer.on_solved(node)
+            yield node
+        observer.on_phase_end(phase)
+
+    def solve_objects(self):
+        for node in self._observe_phase('edges', self.solve_edges()):
+            yield node
+        if self.propagation == 'worklist':
+            propagate = self.solve_worklist
+        else:
+            propagate = self.solve_all
+        for node in self._observe_phase('propagation', propagate()):
+            yield node
+
+    def solve_bitmask(self):
+        """
+        Propagate on the BitBoard. Like solve_objects, yields every square
+        set from the start, then every altered one.
+        """
+        for node in list(self.iter_set()):
+            yield node
+        bits = self.bits
+        if self.propagation == 'vectorized':
+            altered = bits.solve_vectorized()
+        else:
+            altered = bits.solve()
+        for index in altered:
+            # Set squares are never altered, except to a contradiction.
+            if self._bit_is_set(index):
+                self.num_solved += 1
+            yield bits.node(index)
+
+    def solve_edges(self):
+        for node, square in self.board.items():
+            x, y = node
+            was_set = square.is_set()
+            if (x in (self.min_x, self.max_x) or
+                    y in (self.min_y, self.max_y)):
+                square = self._own(node)
+                if self.observer is not None:
+                    before = list(square.connections)
+                if x == self.min_x:
+                    square.delete_connection(3)
+                if y == self.min_y:
+                    square.delete_connection(0)
+                if x == self.max_x:
+                    square.delete_connection(1)
+                if y == self.max_y:
+                    square.delete_connection(2)
+                if (self.observer is not None and
+                        len(square.connections) != len(before)):
+                    removed = [connection for connection in before
+                               if connection not in square.connections]
+                    self.observer.on_prune('edge', node, None, removed)
+            if square.is_set():
+                if not was_set:
+                    self.num_solved += 1
+                yield node
+
+    def solve_all(self):
+        altered_something = True
+        passes = 0
+        while altered_something:
+            altered_something = False
+            passes += 1
+            if self.observer is not None:
+                self.observer.on_pass(passes)
+
+            log.debug('num_solved = %d', self.num_solved)
+            if self.num_solved == len(self.board):
+                log.debug('Solved them all!')
+                break
+
+            for node, square in self.board.items():
+                if not square.connections:
+                    # A contradiction; there's nothing to learn from it.
+                    continue
+                altered_this = self.solve_square(square)
+                altered_something |= altered_this
+                if altered_this:
+                    yield node
+
+    def solve_worklist(self):
+        """
+        AC-3 style propagation: whenever a square changes, only it and its
+        neighbors are queued to be looked at again. Squares left with no
+        connections (a contradiction) are never queued.
+        """
+        observer = self.observer
+        queue = deque(node for node, square in self.board.items()
+                      if square.connections and not square.is_set())
+        queued = set(queue)
+        passes = 0
+        pass_left = 0
+        while queue:
+            if observer is not None:
+                if not pass_left:
+                    passes += 1
+                    pass_left = len(queue)
+                    observer.on_pass(passes)
+                pass_left -= 1
+            node = queue.popleft()
+            queued.discard(node)
+            square = self.board[node]
+            if not self.solve_square(square):
+                continue
+            yield node
+
+            # The square itself is re-queued too; the nub-nub rule depends on
+            # its own state, which may have just changed.
+            for n_node in [node] + square.get_neighbors():
+                n_square = self.board.get(n_node)
+                if (n_square is None or n_square.is_set() or
+                        not n_square.connections):
+                    continue
+                if n_node not in queued:
+                    queued.add(n_node)
+                    queue.append(n_node)
+
+    def solve_search(self, node_budget=None, timeout=None):
+        """
+        Finish the board by branching on the most constrained square,
+        propagating, and backtracking on contradictions.
+
+        Returns True if a solution was found (and leaves it on self.board),
+        or False if the board has no solution.  Raises SearchLimitReached if
+        more than node_budget branches are tried or timeout seconds pass; the
+        board is then left as it was.  self.nodes_explored counts branches.
+        """
+        self.nodes_explored = 0
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        # _snapshot: Every square's connections, kept up to date through
+        #   the search, so saving the board is just keeping a reference.
+        self._snapshot_nodes = [(x, y)
+                                for y in range(self.min_y, self.max_y + 1)
+                                for x in range(self.min_x, self.max_x + 1)]
+        self._snapshot = BoardSnapshot(
+            self._square_state(node) for node in self._snapshot_nodes)
+
+        initial = self._save()
+        consistent = self._propagate([node for node, square
+                                      in self.board.items()
+                                      if not square.is_set()])
+        stack = []
+        while True:
+            if consistent and not self._violates_tree():
+                node = self._most_constrained()
+                if node is None:
+                    if self._is_solution():
+                        return True
+                else:
+                    square = self.board[node]
+                    stack.append((node, list(square.connections),
+                                  self._save()))
+
+            # Find the deepest square with an untried connection.
+            while stack and not stack[-1][1]:
+                stack.pop()
+            if not stack:
+                self._restore(initial)
+                return False
+
+            self.nodes_explored += 1
+            if ((node_budget is not None and
+                 self.nodes_explored > node_budget) or
+                    (deadline is not None and time.time() > deadline)):
+                self._restore(initial)
+                raise SearchLimitReached(
+                    'Gave up after exploring %d nodes.' % self.nodes_explored)
+
+            node, options, saved = stack[-1]
+            self._restore(saved)
+            square = self._own(node)
+            square.connections = [options.pop(0)]
+            square.cursor = 0
+            self.num_solved += 1
+            self._note_changed(node)
+            consistent = (not self._contradicts(node) and
+                          self._propagate(square.get_neighbors()))
+
+    def _save(self):
+        """The BoardSnapshot is immutable, so saving it is free."""
+        return self._snapshot
+
+    def _restore(self, saved):
+        """Put back only the squares that differ from saved."""
+        for index in self._snapshot.diff(saved):
+            square = self._own(self._snapshot_nodes[index])
+            if square.is_set():
+                self.num_solved -= 1
+            square.connections = list(saved[index])
+            square.cursor = 0
+            if square.is_set():
+                self.num_solved += 1
+        self._snapshot = saved
+
+    def _square_state(self, node):
+        square = self.board.get(node)
+        if square is None:
+            return None
+        return tuple(square.connections)
+
+    def _note_changed(self, node):
+        """Bring the search's snapshot up to date with the square at node."""
+        x, y = node
+        index = ((y - self.min_y) * (self.max_x - self.min_x + 1) +
+                 x - self.min_x)
+        self._snapshot = self._snapshot.set(index, self._square_state(node))
+
+    def _most_constrained(self):
+        """The unset square with the fewest connections left, or None."""
+        best = None
+        best_count = None
+        for node, square in self.board.items():
+            count = len(square.connections)
+            if count > 1 and (best_count is None or count < best_count):
+                best = node
+                best_count = count
+        return best
+
+    def _propagate(self, nodes):
+        """
+        Worklist propagation starting from nodes.
+        Returns False if a contradiction was found.
+        """
+        queue = deque(node for node in nodes if node in self.board)
+        queued = set(queue)
+        while queue:
+            node = queue.popleft()
+            queued.discard(node)
+            if not self.board[node].connections:
+                return False
+            if not self.solve_square(self.board[node]):
+                continue
+            square = self.board[node]
+            self._note_changed(node)
+            if not square.connections:
+                return False
+            if square.is_set() and self._contradicts(node):
+                return False
+            for n_node in [node] + square.get_neighbors():
+                n_square = self.board.get(n_node)
+                if n_square is None or n_square.is_set():
+                    continue
+                if n_node not in queued:
+                    queued.add(n_node)
+                    queue.append(n_node)
+        return True
+
+    def _contradicts(self, node):
+        """Returns True if a set square disagrees with a set neighbor."""
+        connection = self.board[node].get_connection()
+        for direction, n_node in enumerate(self.board[node].get_neighbors()):
+            n_square = self.board.get(n_node)
+            if n_square is None:
+                if direction in connection:
+                    return True
+                continue
+            if not n_square.is_set():
+                continue
+            his_link = (direction + 2) % 4
+            his_connection = n_square.get_connection()
+            if (direction in connection) != (his_link in his_connection):
+                return True
+        return False
+
+    def _violates_tree(self):
+        """
+        The links that must be used can't form a loop, and the links that
+        might be used must still connect the whole board.
+        """
+        if not all(square.connections for square in self.board.itervalues()):
+            # A contradiction, which breaks the tree too.
+            return True
+        forced = graphlib.DisjointSet(self.board)
+        possible = graphlib.DisjointSet(self.board)
+        for node, square in self.board.items():
+            must = frozenset.intersection(*square.connections)
+            may = frozenset.union(*square.connections)
+            neighbors = square.get_neighbors()
+            for direction in (1, 2):
+                n_square = self.board.get(neighbors[direction])
+                if n_square is None:
+                    continue
+                his_link = (direction + 2) % 4
+                his_must = frozenset.intersection(*n_square.connections)
+                his_may = frozenset.union(*n_square.connections)
+                if direction in must or his_link in his_must:
+                    if not forced.union(node, n_square.node):
+                        return True
+                if direction in may and his_link in his_may:
+                    possible.union(node, n_square.node)
+
+        return possible.num_sets != 1
+
+    def _is_solution(self):
+        """Every link is matched, and the links form a single tree."""
+        links = 0
+        for node in self.board:
+            if self._contradicts(node):
+                return False
+            links += len(self.board[node].get_connection())
+        return links == 2 * (len(self.board) - 1)
+
+    def solve_square(self, square):
+        modified = False
+        if square.is_set():
+            return modified
+        square = self._own(square.node)
+        observer = self.observer
+        for n_node in square.get_neighbors():
+            try:
+                n_square = self.board[n_node]
+            except (KeyError, IndexError):
+                continue
+            modified_this = square.learn_from_neighbor(n_square, observer)
+            if observer is not None:
+                observer.on_learn(square.node, n_node, modified_this)
+            modified |= modified_this
+            if not square.connections:
+                # A contradiction; there's nothing left to learn.
+                break
+        if modified and square.is_set():
+            self.num_solved += 1
+        return modified
+
+
+class BackgroundSolver(object):
+    """
+    Runs a Solver over a Board in a worker thread or, with use_process, a
+    worker process (which doesn't compete for the GIL). Every square it
+    sets is put on a queue as (node, connection) as soon as it's found;
+    drain takes them off without blocking.
+
+    All that's copied from the board is its solution, a byte per square,
+    so it can be played with meanwhile; the worker makes the Solver (how
+    the squares are turned doesn't matter to it). Cancelling stops the
+    worker at its next square; a search (see Solver) can't be interrupted
+    partway.
+    """
+
+    def __init__(self, board, use_process=False, **solver_options):
+        shape = (len(board.xs), len(board.ys), bytearray(board.solution))
+        if use_process:
+            self.results = multiprocessing.Queue()
+            self.cancelled = multiprocessing.Event()
+            worker_class = multiprocessing.Process
+        else:
+            self.results = Queue.Queue()
+            self.cancelled = threading.Event()
+            worker_class = threading.Thread
+        self.use_process = use_process
+        self.worker = worker_class(target=_solve_into,
+                                   args=(shape, solver_options, self.results,
+                                         self.cancelled))
+        # Nobody should have to wait for a worker to quit.
+        self.worker.daemon = True
+        # done: Every result has been drained.
+        self.done = False
+
+    def start(self):
+        self.worker.start()
+
+    def cancel(self):
+        """Stop solving; nothing more will be drained."""
+        self.cancelled.set()
+        self.done = True
+        if self.use_process and self.worker.is_alive():
+            # It may be stuck putting results nobody will take.
+            self.worker.terminate()
+
+    def join(self, timeout=None):
+        """Wait (up to timeout seconds) for the worker to quit."""
+        self.worker.join(timeout)
+
+    def drain(self, limit=None):
+        """
+        Yields up to limit (node, connection) results that are ready,
+        without waiting for any more.
+        """
+        count = 0
+        while not self.done and (limit is None or count < limit):
+            try:
+                result = self.results.get_nowait()
+            except Queue.Empty:
+                return
+            if result is None:
+                self.done = True
+                return
+            count += 1
+            yield result
+
+
+def _solve_into(shape, solver_options, results, cancelled):
+    """
+    The BackgroundSolver worker: make a Solver from shape, (columns, rows,
+    masks), and solver_options, and put what it sets on results, until
+    it's done or cancelled, then None.
+    """
+    try:
+        columns, rows, masks = shape
+        solver = Solver(BitBoard.from_masks(columns, rows, masks),
+                        **solver_options)
+        for node, connection in solver.iter_connections():
+            if cancelled.is_set():
+                break
+            results.put((node, connection))
+    finally:
+        results.put(None)
+
+
+def connection_mask(connection):
+    """The 4-bit mask of a connection; bit n is set if it uses direction n."""
+    mask = 0
+    for direction in connection:
+        mask |= 1 << direction
+    return mask
+
+
+# MASK_CONNECTIONS[m]: The connection whose connection_mask is m.
+MASK_CONNECTIONS = tuple(frozenset(direction for direction in range(4)
+                                   if mask & (1 << direction))
+                         for mask in range(16))
+# ROTATION_CANDIDATES[m]: The candidate mask of every rotation of mask m.
+ROTATION_CANDIDATES = tuple(
+    sum(set(1 << ((mask << turn | mask >> (4 - turn)) & 0xf)
+            for turn in range(4)))
+    for mask in range(16))
+# LINK_CANDIDATES[n]: The candidate mask of every connection using direction n.
+LINK_CANDIDATES = tuple(sum(1 << mask for mask in range(16) if mask & (1 << n))
+                        for n in range(4))
+# NUB_CANDIDATES: The candidate mask of every end-cap.
+NUB_CANDIDATES = sum(1 << (1 << n) for n in range(4))
+
+# _LOWEST_BIT[m]: The index of the lowest bit set in m, as a numpy array
+# (made by _load_numpy).
+_LOWEST_BIT = None
+
+
+def _load_numpy():
+    """
+    Returns numpy, importing it and making the tables that use it the first
+    time. Raises ImportError if it isn't installed.
+    """
+    global numpy, _LOWEST_BIT
+    if numpy is None:
+        import numpy as module
+        lowest_bit = module.zeros(1 << 16, dtype=module.uint8)
+        for bit in range(15, -1, -1):
+            lowest_bit[(module.arange(1 << 16) >> bit) & 1 == 1] = bit
+        _LOWEST_BIT = lowest_bit
+        numpy = module
+    return numpy
+
+
+def can_vectorize():
+    """Returns True if 'vectorized' propagation can run (numpy is there)."""
+    try:
+        _load_numpy()
+    except ImportError:
+        return False
+    return True
+
+
+class BitBoard(object):
+    """
+    A compact, rectangular Pipes board.
+
+    Each square is a 4-bit connection mask (its current orientation) plus a
+    16-bit candidate mask, where bit m is set if the connection with mask m
+    is still possible.  Both live in flat arrays indexed by y * width + x.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.connections = array('B', [0]) * (width * height)
+        self.candidates = array('H', [0]) * (width * height)
+
+    @classmethod
+    def from_board(cls, board):
+        """Build a BitBoard from a dict of PipeSegments keyed by node."""
+        width = max(x for x, y in board) + 1
+        height = max(y for x, y in board) + 1
+        bits = cls(width, height)
+        for node, square in board.items():
+            index = bits.index(node)
+            bits.connections[index] = connection_mask(square.get_connection())
+            for connection in square.connections:
+                bits.candidates[index] |= 1 << connection_mask(connection)
+        return bits
+
+    @classmethod
+    def from_masks(cls, width, height, masks):
+        """
+        Build a BitBoard from the connection_mask of every square, row by
+        row, such as Board.solution or PuzzleRecord.masks(). Every rotation
+        of a square is a candidate, so it doesn't matter which way the
+        squares are turned.
+        """
+        if len(masks) != width * height:
+            raise ValueError('Expected %d masks, got %d.'
+                             % (width * height, len(masks)))
+        bits = cls(width, height)
+        bits.connections = array('B', masks)
+        bits.candidates = array('H', (ROTATION_CANDIDATES[mask]
+                                      for mask in masks))
+        return bits
+
+    def copy(self):
+        bits = type(self)(0, 0)
+        bits.width = self.width
+        bits.height = self.height
+        bits.connections = self.connections[:]
+        bits.candidates = self.candidates[:]
+        return bits
+
+    def squares(self, segment_class=PipeSegment):
+        """
+        A dict of segment_class squares keyed by node, with the connections
+        still among the candidates (none, for a contradiction).
+        """
+        squares = {}
+        for index in range(len(self)):
+            node = self.node(index)
+            candidates = self.candidates[index]
+            square = segment_class(MASK_CONNECTIONS[self.connections[index]],
+                                   node)
+            square.connections = [
+                connection for connection in square.connections
+                if candidates & (1 << connection_mask(connection))]
+            square.cursor = 0
+            squares[node] = square
+        return squares
+
+    def __len__(self):
+        return self.width * self.height
+
+    def index(self, node):
+        x, y = node
+        return y * self.width + x
+
+    def node(self, index):
+        y, x = divmod(index, self.width)
+        return (x, y)
+
+    def neighbor(self, index, direction):
+        """The index next to index in direction, or None if off the board."""
+        y, x = divmod(index, self.width)
+        if direction == 0:
+            return index - self.width if y > 0 else None
+        elif direction == 1:
+            return index + 1 if x < self.width - 1 else None
+        elif direction == 2:
+            return index + self.width if y < self.height - 1 else None
+        return index - 1 if x > 0 else None
+
+    def is_set(self, index):
+        """Returns True if the square only has one possibility."""
+        candidates = self.candidates[index]
+        return candidates & (candidates - 1) == 0
+
+    def _restrict(self, index, allowed):
+        """Keep only the allowed candidates. Returns True if any were lost."""
+        candidates = self.candidates[index]
+        if candidates & allowed == candidates:
+            return False
+        candidates &= allowed
+        self.candidates[index] = candidates
+        if candidates and not candidates & (1 << self.connections[index]):
+            # Point the square at its lowest remaining candidate.
+            lowest = candidates & -candidates
+            self.connections[index] = lowest.bit_length() - 1
+        return True
+
+    def solve_edges(self):
+        """Remove links that point off the board. Yields altered squares."""
+        for index in range(len(self)):
+            allowed = 0xffff
+            for direction in range(4):
+                if self.neighbor(index, direction) is None:
+                    allowed &= ~LINK_CANDIDATES[direction]
+            if self._restrict(index, allowed):
+                yield index
+
+    def learn_from_neighbor(self, index, direction):
+        """
+        The bit-operation version of PipeSegment.learn_from_neighbor.
+        Returns True if the square at index was modified.
+        """
+        n_index = self.neighbor(index, direction)
+        mine = self.candidates[index]
+        his = self.candidates[n_index]
+        my_link = LINK_CANDIDATES[direction]
+        his_link = LINK_CANDIDATES[(direction + 2) % 4]
+
+        allowed = 0xffff
+        if not his & ~his_link:
+            # Our link MUST be used.
+            allowed &= my_link
+        if (not his & his_link or
+                (not mine & ~NUB_CANDIDATES and not his & ~NUB_CANDIDATES)):
+            # Our link MUST NOT be used.
+            allowed &= ~my_link
+        return self._restrict(index, allowed)
+
+    def solve_square(self, index):
+        modified = False
+        if self.is_set(index):
+            return modified
+        for direction in range(4):
+            if self.neighbor(index, direction) is not None:
+                modified |= self.learn_from_neighbor(index, direction)
+        return modified
+
+    def solve(self):
+        """Solve edges, then propagate. Yields every altered index."""
+        for index in self.solve_edges():
+            yield index
+        for index in self.propagate():
+            yield index
+
+    def propagate(self):
+        """Worklist propagation. Yields every altered index."""
+        queued = bytearray(len(self))
+        queue = deque()
+        for index in range(len(self)):
+            if not self.is_set(index):
+                queued[index] = 1
+                queue.append(index)
+        while queue:
+            index = queue.popleft()
+            queued[index] = 0
+            if not self.solve_square(index):
+                continue
+            yield index
+
+            for direction in range(4):
+                n_index = self.neighbor(index, direction)
+                if n_index is None or queued[n_index]:
+                    continue
+                if not self.is_set(n_index):
+                    queued[n_index] = 1
+                    queue.append(n_index)
+            if not self.is_set(index) and not queued[index]:
+                queued[index] = 1
+                queue.append(index)
+
+    def solve_vectorized(self):
+        """
+        Apply the learn_from_neighbor rules to every square at once with
+        NumPy array shifts, sweeping until nothing changes.
+        Returns the indices of every altered square.
+        """
+        try:
+            numpy = _load_numpy()
+        except ImportError:
+            raise ImportError('Vectorized solving requires numpy.')
+
+        shape = (self.height, self.width)
+        candidates = numpy.frombuffer(self.candidates,
+                                      dtype=numpy.uint16).reshape(shape)
+        original = candidates.copy()
+
+        # Edge pruning only ever needs to happen once.
+        candidates[0, :] &= ~LINK_CANDIDATES[0] & 0xffff
+        candidates[:, -1] &= ~LINK_CANDIDATES[1] & 0xffff
+        candidates[-1, :] &= ~LINK_CANDIDATES[2] & 0xffff
+        candidates[:, 0] &= ~LINK_CANDIDATES[3] & 0xffff
+
+        # Off the board, neighbors are all candidates: no rule can fire.
+        neighbors = numpy.empty(shape, dtype=numpy.uint16)
+        not_nubs = ~NUB_CANDIDATES & 0xffff
+        while True:
+            is_nub = (candidates & not_nubs) == 0
+            allowed = numpy.full(shape, 0xffff, dtype=numpy.uint16)
+            for direction in range(4):
+                neighbors.fill(0xffff)
+                if direction == 0:
+                    neighbors[1:, :] = candidates[:-1, :]
+                elif direction == 1:
+                    neighbors[:, :-1] = candidates[:, 1:]
+                elif direction == 2:
+                    neighbors[:-1, :] = candidates[1:, :]
+                else:
+                    neighbors[:, 1:] = candidates[:, :-1]
+
+                my_link = LINK_CANDIDATES[direction]
+                his_link = LINK_CANDIDATES[(direction + 2) % 4]
+                # Our link MUST be used.
+                must_use = (neighbors & (~his_link & 0xffff)) == 0
+                # Our link MUST NOT be used.
+                must_not_use = (((neighbors & his_link) == 0) |
+                                (is_nub & ((neighbors & not_nubs) == 0)))
+                allowed[must_use] &= my_link
+                allowed[must_not_use] &= ~my_link & 0xffff
+
+            # Like solve_square, leave set squares alone.
+            is_set = (candidates & (candidates - 1)) == 0
+            allowed[is_set] = 0xffff
+            restricted = candidates & allowed
+            if numpy.array_equal(restricted, candidates):
+                break
+            candidates[...] = restricted
+
+        # Point squares at their lowest remaining candidate if needed.
+        connections = numpy.frombuffer(self.connections,
+                                       dtype=numpy.uint8).reshape(shape)
+        lost = ((candidates >> connections) & 1) == 0
+        lowest = _LOWEST_BIT[candidates[lost]]
+        connections[lost] = numpy.where(candidates[lost] != 0, lowest,
+                                        connections[lost])
+
+        return numpy.flatnonzero(candidates != original).tolist()
+
+    def mark_attached(self, source):
+        """
+        Returns a bytearray flagging every square attached to source through
+        the squares' current connections.
+        """
+        attached = bytearray(len(self))
+        stack = [self.index(source)]
+        while stack:
+            index = stack.pop()
+            if attached[index]:
+                continue
+            attached[index] = 1
+            connection = self.connections[index]
+            for direction in range(4):
+                if not connection & (1 << direction):
+                    continue
+                n_index = self.neighbor(index, direction)
+                if n_index is None or attached[n_index]:
+                    continue
+                if self.connections[n_index] & (1 << ((direction + 2) % 4)):
+                    stack.append(n_index)
+        return attached
+
+
+# Seeds fit in a pack record's 64 bit seed field.
+MAX_SEED = 1 << 63
+
+
+class Board(object):
+    """
+    A game of Pipes with no display: the squares, the source, and which
+    squares are attached to the source.
+    """
+
+    segment_class = PipeSegment
+    # The most moves that can be undone.
+    max_history = 1000
+
+    def __init__(self, columns, rows=None, generator='kruskal', seed=None):
+        """
+        Constructor for Board; size is either an int or pair of ints.
+        generator is the graphlib spanning tree algorithm used by generate.
+        seed fixes everything random about the board (see reseed); by
+        default one is picked at random.
+        """
+        x = int(columns)
+        y = x
+        if rows:
+            y = int(rows)
+
+        self.xs = range(x)
+        self.ys = range(y)
+        self.generator = generator
+
+        self.board = {}
+        self.source = (0, 0)
+        # solution: Every square's solved connection_mask, row by row.
+        self.solution = None
+        self.reseed(seed)
+
+        # attached_count: How many squares are attached to the source.
+        # _attached_parent: For each attached square, the square it was
+        #   reached from (None for the source); together, a tree.
+        self.attached_count = 0
+        self._attached_parent = {}
+
+        # known: The connection of every square known to be solved, e.g.
+        #   by a Solver.
+        # known_wrong: The known squares not currently rotated that way.
+        self.known = {}
+        self.known_wrong = set()
+
+        # _position: A BoardSnapshot of every square (see _square_state).
+        # _undo, _redo: (node, position) for every move that can be undone
+        #   or redone; position is the one on the other side of the move.
+        self._position = None
+        self._undo = deque(maxlen=self.max_history)
+        self._redo = []
+
+    def reseed(self, seed=None):
+        """
+        Start self.random, the source of everything random about the board,
+        over from seed. The same seed, size and generator always give the
+        same board and the same jumble. If seed is None one is picked.
+        """
+        if seed is None:
+            seed = random.SystemRandom().randrange(MAX_SEED)
+        self.seed = seed
+        self.random = random.Random(seed)
+
+    def generate(self):
+        """Generate a starting Pipes setup."""
+
+        graph = graphlib.GridGraph(len(self.xs), len(self.ys), connected=True)
+        # Only the minimum spanning tree algorithms need random weights.
+        if self.generator in ('kruskal', 'prim'):
+            graph.set_weights(self.random.random)
+
+        graph = graph.min_span_tree(self.generator, self.random)
+        for node in sorted(graph):
+            links = graph.neighbors(node)
+            connections = []
+            sx, sy = node
+            for rx, ry in links:
+                if sx == rx and sy == ry + 1:
+                    connections.append(0)
+                elif sx == rx - 1 and sy == ry:
+                    connections.append(1)
+                elif sx == rx and sy == ry - 1:
+                    connections.append(2)
+                elif sx == rx + 1 and sy == ry:
+                    connections.append(3)
+
+            self.board[node] = self.segment_class(frozenset(connections),
+                                                  node)
+        self.forget_known()
+        # jumble takes the first snapshot.
+        self.forget_history(snapshot=False)
+
+        self.source = self.random.choice(sorted(self.board))
+        self.solution = bytearray(
+            connection_mask(self.board[(x, y)].get_connection())
+            for y in self.ys
+            for x in self.xs)
+
+    def load(self, record):
+        """Set up the board from a packlib.PuzzleRecord instead of generate."""
+        self.xs = range(record.width)
+        self.ys = range(record.height)
+        self.source = record.source
+        self.reseed(record.seed)
+        self.solution = record.masks()
+
+        self.board = {}
+        masks = iter(self.solution)
+        for y in self.ys:
+            for x in self.xs:
+                mask = next(masks)
+                connection = frozenset(direction for direction in range(4)
+                                       if mask & (1 << direction))
+                self.board[(x, y)] = self.segment_class(connection, (x, y))
+        self.forget_known()
+        self.forget_history()
+
+    def load_from_pack(self, path, index=0):
+        """Set up the board from puzzle number index of a pack file."""
+        with packlib.PuzzlePack(path) as pack:
+            self.load(pack[index])
+
+    def save_to_pack(self, path, append=True):
+        """Add the board's puzzle (its solution) to a pack file."""
+        with packlib.PackWriter(path, append) as writer:
+            writer.write(len(self.xs), len(self.ys), self.source, self.seed,
+                         self.solution)
+
+    def __unicode__(self):
+        """A unicode grid of the pipes grid."""
+        ret_str = []
+        for y in self.ys:
+            for x in self.xs:
+                ret_str.append(unicode(self.board[(x, y)]))
+            ret_str.append(u'\n')
+
+        return u''.join(ret_str)
+
+    def jumble(self):
+        """Randomly rotate every square, then work out what's attached."""
+        # Row by row, so the jumble only depends on the seed.
+        for y in self.ys:
+            for x in self.xs:
+                self.board[(x, y)].on_init(self.random)
+        self.known_wrong = set(node for node in self.known
+                               if not self._is_known_right(node))
+        self.forget_history()
+        self.mark_attached()
+
+    def rotate_square(self, node, clockwise=True):
+        """Rotate the square at node, and update what's attached."""
+        before = self.snapshot()
+        if clockwise:
+            self.board[node].rotate_right()
+        else:
+            self.board[node].rotate_left()
+        self._record_move(node, before)
+        self._square_changed(node)
+
+    def fix_square(self, node, connection):
+        """Lock the square at node into connection, e.g. for a hint."""
+        before = self.snapshot()
+        square = self.board[node]
+        square.connections = [connection]
+        square.cursor = 0
+        self._record_move(node, before)
+        self._square_changed(node)
+
+    def _square_changed(self, node):
+        self.on_square_changed(node)
+        self._update_known(node)
+        self.update_attached(node)
+
+    #### History ####
+    def snapshot(self):
+        """
+        A BoardSnapshot of every square (see _square_state), row by row.
+        It costs next to nothing; see restore.
+        """
+        if self._position is None:
+            self._position = BoardSnapshot(
+                self._square_state(self.board[(x, y)])
+                for y in self.ys
+                for x in self.xs)
+        return self._position
+
+    def restore(self, position):
+        """
+        Put the board back how it was when position was taken. Only the
+        squares that differ are touched.
+        """
+        current = self.snapshot()
+        width = len(self.xs)
+        for index in current.diff(position):
+            node = (index % width, index // width)
+            square = self.board[node]
+            state = position[index]
+            if isinstance(state, tuple):
+                connections, square.cursor = state
+            else:
+                connections = END_SET_OF[square.connections[0]]
+                square.cursor = state
+            square.connections = list(connections)
+            self._square_changed(node)
+        self._position = position
+
+    def undo(self):
+        """Take back the last move. Returns its node, or None if none."""
+        if not self._undo:
+            return None
+        node, position = self._undo.pop()
+        self._redo.append((node, self.snapshot()))
+        self.restore(position)
+        return node
+
+    def redo(self):
+        """Make the last undone move again. Returns its node, or None."""
+        if not self._redo:
+            return None
+        node, position = self._redo.pop()
+        self._undo.append((node, self.snapshot()))
+        self.restore(position)
+        return node
+
+    def forget_history(self, snapshot=True):
+        """
+        Start the history over from the board as it is. With snapshot, its
+        first snapshot is taken now rather than on the first move.
+        """
+        self._position = None
+        self._undo.clear()
+        self._redo = []
+        if snapshot:
+            self.snapshot()
+
+    def _record_move(self, node, before):
+        """
+        Add the change just made to the square at node to the history;
+        before is the snapshot from just before it.
+        """
+        x, y = node
+        index = y * len(self.xs) + x
+        state = self._square_state(self.board[node], before[index])
+        self._position = before.set(index, state)
+        self._undo.append((node, before))
+        self._redo = []
+
+    def _square_state(self, square, old_state=None):
+        """
+        What a snapshot keeps of square: its cursor, or, once some of its
+        connections are gone (to a hint, say), (connections, cursor),
+        sharing old_state's connections if they're equal. Mostly ints, so
+        snapshotting a whole board makes next to no objects.
+        """
+        connections = square.connections
+        if len(connections) == len(END_SET_OF[connections[0]]):
+            return square.cursor
+        connections = tuple(connections)
+        if isinstance(old_state, tuple) and old_state[0] == connections:
+            connections = old_state[0]
+        return (connections, square.cursor)
+
+    #### Hints ####
+    def solve_known(self, **solver_options):
+        """
+        Run a Solver (made with solver_options) over the board to the end,
+        and add every square it sets to what's known.
+        """
+        solver = Solver(self.board, **solver_options)
+        for node, connection in solver.iter_connections():
+            self.add_known(node, connection)
+
+    def add_known(self, node, connection):
+        """The square at node is known to be solved as connection."""
+        self.known[node] = connection
+        self._update_known(node)
+
+    def forget_known(self):
+        """Nothing is known about the board (e.g. it's a new one)."""
+        self.known = {}
+        self.known_wrong = set()
+
+    def pop_hint(self):
+        """
+        A (node, connection) for a known square that's rotated wrong, or
+        None if there aren't any. It's no longer counted as wrong.
+        """
+        if not self.known_wrong:
+            return None
+        node = self.known_wrong.pop()
+        return (node, self.known[node])
+
+    def _is_known_right(self, node):
+        return self.board[node].get_connection() == self.known[node]
+
+    def _update_known(self, node):
+        """Keep known_wrong up to date after the square at node turned."""
+        if node not in self.known:
+            return
+        if self._is_known_right(node):
+            self.known_wrong.discard(node)
+        else:
+            self.known_wrong.add(node)
+
+    def mark_attached(self):
+        """Work out which squares are attached to the source from scratch."""
+        for square in self.board.values():
+            square.is_attached = False
+        self.attached_count = 0
+        self._attached_parent = {}
+        self.on_board_changed()
+
+        self._flood_attached([(self.source, None)])
+
+    def update_attached(self, node):
+        """
+        Fix up which squares are attached after the square at node changed.
+
+        Only squares below node in the attached tree can have lost their way
+        to the source, so only they are detached and re-flooded.
+        """
+        if node == self.source:
+            self.mark_attached()
+            return
+
+        seeds = []
+        square = self.board[node]
+        if square.is_attached:
+            for d_node in self._detach_below(node):
+                d_square = self.board[d_node]
+                for potential in d_square.get_possible_connected_nodes():
+                    p_square = self.board.get(potential)
+                    if (p_square is not None and p_square.is_attached and
+                            p_square.is_connected_to(d_node)):
+                        seeds.append((d_node, potential))
+                        break
+        else:
+            for potential in square.get_possible_connected_nodes():
+                p_square = self.board.get(potential)
+                if (p_square is not None and p_square.is_attached and
+                        p_square.is_connected_to(node)):
+                    seeds.append((node, potential))
+                    break
+
+        self._flood_attached(seeds)
+
+    def _detach_below(self, node):
+        """
+        Detach node and every square reached through it in the attached
+        tree. Returns the detached nodes.
+        """
+        detached = []
+        below = [node]
+        while below:
+            b_node = below.pop()
+            detached.append(b_node)
+            for n_node in self.board[b_node].get_neighbors():
+                if (n_node in self._attached_parent and
+                        self._attached_parent[n_node] == b_node):
+                    below.append(n_node)
+
+        for d_node in detached:
+            self.board[d_node].is_attached = False
+            del self._attached_parent[d_node]
+            self.on_square_changed(d_node)
+        self.attached_count -= len(detached)
+        return detached
+
+    def _flood_attached(self, seeds):
+        """
+        Attach each (node, parent) in seeds and every unattached square
+        connected to them.
+        """
+        attached_nodes = deque(seeds)
+        while attached_nodes:
+            node, parent = attached_nodes.pop()
+            square = self.board.get(node)
+            if square is None or square.is_attached:
+                continue
+            square.is_attached = True
+            self._attached_parent[node] = parent
+            self.attached_count += 1
+            self.on_square_changed(node)
+
+            for potential in square.get_possible_connected_nodes():
+                p_square = self.board.get(potential)
+                if p_square is None or p_square.is_attached:
+                    continue
+                if p_square.is_connected_to(node):
+                    attached_nodes.append((potential, node))
+
+    def is_complete(self):
+        """Returns True if every square is attached to the source."""
+        return self.attached_count == len(self.board)
+
+    def on_square_changed(self, node):
+        """Called when a square's rotation or attached state changes."""
+        pass
+
+    def on_board_changed(self):
+        """Called when any or every square may have changed."""
+        pass
+
+
+#### Batch generation ####
+def encode_puzzle(width, height, source, masks):
+    """
+    A compact, one line form of a puzzle:
+    'width height source_x source_y masks', where masks has one hex digit
+    (the connection_mask) per square, row by row.
+    """
+    source_x, source_y = source
+    return '%d %d %d %d %s' % (width, height, source_x, source_y,
+                               ''.join('%x' % mask for mask in masks))
+
+
+def is_solvable(board, verify):
+    """
+    Returns True if Solver can finish board. verify can be:
+    'propagation': With propagation alone.
+    'search': With propagation and a (bounded) search.
+    """
+    solver = Solver(board.board, search=(verify == 'search'),
+                    node_budget=10000)
+    for node in solver.iter_altered():
+        pass
+    return solver.is_solved()
+
+
+def generate_puzzle(columns, rows, generator='kruskal', verify=None,
+                    max_attempts=100, seed=None):
+    """
+    Generate a Board. With verify (see is_solvable), keep going until one
+    can be solved that way; give up and return None after max_attempts.
+    The first attempt uses seed, and later ones seeds derived from it.
+    """
+    rng = random.Random(seed)
+    board_seed = seed
+    for attempt in range(max_attempts):
+        board = Board(columns, rows, generator, board_seed)
+        board.generate()
+        if verify is None or is_solvable(board, verify):
+            return board
+        board_seed = rng.randrange(MAX_SEED)
+    return None
+
+
+def _generate_puzzle_fields(args):
+    """
+    generate_puzzle for a worker process. Returns
+    (width, height, source, seed, masks), or None.
+    """
+    board = generate_puzzle(*args)
+    if board is None:
+        return None
+    return (len(board.xs), len(board.ys), board.source, board.seed,
+            board.solution)
+
+
+def generate_batch(count, columns, rows, output, generator='kruskal',
+                   verify=None, processes=None, seed=None):
+    """
+    Generate count puzzles across a pool of processes, writing each to the
+    file output in order. If output ends in '.pack' it's a packlib pack;
+    otherwise a line per puzzle (see encode_puzzle).
+    Puzzle i is generated from seed + i, so the same seed gives the same
+    file; by default seed is picked at random.
+    Returns the number written; puzzles that fail verify are dropped.
+    """
+    if seed is None:
+        seed = random.SystemRandom().randrange(MAX_SEED)
+    pool = multiprocessing.Pool(processes)
+    written = 0
+    try:
+        tasks = [(columns, rows, generator, verify, 100, (seed + i) % MAX_SEED)
+                 for i in range(count)]
+        if output.endswith('.pack'):
+            writer = packlib.PackWriter(output)
+            write = writer.write
+        else:
+            writer = open(output, 'w')
+
+            def write(width, height, source, seed, masks):
+                line = encode_puzzle(width, height, source, masks)
+                writer.write(line + '\n')
+        with writer:
+            for fields in pool.imap(_generate_puzzle_fields, tasks):
+                if fields is None:
+                    continue
+                write(*fields)
+                written += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return written
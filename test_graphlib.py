@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+Regression checks for graphlib. Run with: python -m unittest test_graphlib
+"""
+
+import random
+import unittest
+
+import graphlib
+
+
+class GridKruskalTest(unittest.TestCase):
+
+    def test_matches_generic_kruskal(self):
+        """GridGraph's own Kruskal finds the same tree as the generic one."""
+        for seed in range(20):
+            rng = random.Random(seed)
+            graph = graphlib.GridGraph(rng.randint(2, 30), rng.randint(2, 30),
+                                       connected=True)
+            graph.set_weights(rng.random)
+            expected = graphlib.UndirectedGraph.min_span_tree_kruskal(graph)
+            mst = graph.min_span_tree_kruskal()
+            self.assertEqual(sorted(mst.iter_edges()),
+                             sorted(expected.iter_edges()))
+
+    def test_equal_weights(self):
+        mst = graphlib.GridGraph(7, 5, connected=True).min_span_tree_kruskal()
+        self.assertEqual(len(list(mst.iter_edges())), 7 * 5 - 1)
+        n_distance, n_parent = mst.bfs_tree((0, 0))
+        self.assertEqual(len(n_distance), 7 * 5)
+
+    def test_not_connected(self):
+        graph = graphlib.GridGraph(3, 3)
+        self.assertRaises(graphlib.InvalidGraphError,
+                          graph.min_span_tree_kruskal)
+
+
+class AStarTest(unittest.TestCase):
+
+    def test_weighted_grid(self):
+        """On a grid weighted like pipes weights it, A* finds shortest paths."""
+        for seed in range(10):
+            graph = graphlib.GridGraph(20, 20, connected=True)
+            graph.set_weights(random.Random(seed).random)
+            expected, path = graph.shortest_path_found((0, 0), (19, 19))
+            distance, path = graph.astar((0, 0), (19, 19),
+                                         graph.manhattan_heuristic())
+            self.assertAlmostEqual(distance, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
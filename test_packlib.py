@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""
+Regression checks for packlib. Run with: python -m unittest test_packlib
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import packlib
+
+
+class PackVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'puzzles.pack')
+        with packlib.PackWriter(self.path) as writer:
+            writer.write(3, 1, (0, 0), 7, bytearray([2, 10, 8]))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def set_version(self, version):
+        with open(self.path, 'r+b') as pack_file:
+            pack_file.seek(len(packlib.MAGIC))
+            pack_file.write(struct.pack('<H', version))
+
+    def test_round_trip(self):
+        with packlib.PackWriter(self.path, append=True) as writer:
+            writer.write(1, 2, (0, 1), 8, bytearray([4, 1]))
+        with packlib.PuzzlePack(self.path) as pack:
+            self.assertEqual([(record.seed, list(record.masks()))
+                              for record in pack],
+                             [(7, [2, 10, 8]), (8, [4, 1])])
+
+    def test_other_version(self):
+        """A pack of another version is neither read nor appended to."""
+        self.set_version(packlib.VERSION + 1)
+        size = os.path.getsize(self.path)
+        self.assertRaises(packlib.PackError, packlib.PuzzlePack, self.path)
+        self.assertRaises(packlib.PackError, packlib.PackWriter, self.path,
+                          append=True)
+        self.assertEqual(os.path.getsize(self.path), size)
+
+
+if __name__ == '__main__':
+    unittest.main()
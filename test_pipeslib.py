@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+Regression checks for pipeslib. Run with: python -m unittest test_pipeslib
+"""
+
+import unittest
+
+import pipeslib
+
+
+def propagations():
+    """
+    Every Solver propagation mode that can run here; the BitBoard ones
+    ('bitmask' and maybe 'vectorized') come last.
+    """
+    modes = ['worklist', 'sweep', 'bitmask']
+    if pipeslib.can_vectorize():
+        modes.append('vectorized')
+    return modes
+
+
+class SolverSearchTest(unittest.TestCase):
+
+    def check_search(self, size, seeds):
+        """
+        Run the search to the end on every seeded board; none may fail, and
+        some boards propagation alone can't finish must be finished by it.
+        """
+        searched = 0
+        for seed in seeds:
+            board = pipeslib.Board(size, seed=seed)
+            board.generate()
+            board.jumble()
+            solver = pipeslib.Solver(board.board)
+            for node in solver.iter_altered():
+                pass
+            if solver.is_solved():
+                continue
+
+            solver = pipeslib.Solver(board.board, search=True,
+                                     node_budget=2000)
+            for node in solver.iter_altered():
+                pass
+            if not solver.is_solved():
+                continue
+            searched += 1
+            solved = pipeslib.Board(size)
+            solved.board = dict(
+                (node, pipeslib.PipeSegment(solver.get_connection(node), node))
+                for node in solver.iter_set())
+            solved.source = board.source
+            solved.mark_attached()
+            self.assertEqual(solved.attached_count, len(board.board),
+                             'Seed %d: not a solution' % seed)
+        self.assertGreater(searched, 0)
+
+    def test_search_small_boards(self):
+        # Seed 95 once emptied a square partway through solve_square.
+        self.check_search(12, range(100))
+
+    def test_search_larger_boards(self):
+        self.check_search(20, range(30))
+
+
+    def test_contradiction(self):
+        """A board with no solution is searched without error."""
+        board = pipeslib.Board(8, 6, seed=4)
+        board.generate()
+        board.jumble()
+        right = board.board[(3, 3)].get_connection()
+        wrong = [connection for connection in pipeslib.END_SET_OF[right]
+                 if connection != right]
+        board.fix_square((3, 3), wrong[0])
+        for propagation in propagations():
+            solver = pipeslib.Solver(board.board, propagation=propagation,
+                                     search=True)
+            for node in solver.iter_altered():
+                pass
+            self.assertFalse(solver.is_solved())
+
+
+class BitBoardSolverTest(unittest.TestCase):
+
+    def test_bitmask_matches_worklist(self):
+        """The BitBoard modes deduce what the squares do, without squares."""
+        for seed in range(20):
+            board = pipeslib.Board(9, 7, seed=seed)
+            board.generate()
+            board.jumble()
+            expected = dict(pipeslib.Solver(board.board).iter_connections())
+            bits = pipeslib.BitBoard.from_masks(9, 7, board.solution)
+            for propagation in propagations()[2:]:
+                for source in (board.board, bits):
+                    solver = pipeslib.Solver(source, propagation=propagation)
+                    self.assertEqual(dict(solver.iter_connections()),
+                                     expected)
+                    self.assertIsNone(solver.board)
+
+
+class BoardHistoryTest(unittest.TestCase):
+
+    def state(self, board):
+        return dict((node, (list(square.connections), square.cursor))
+                    for node, square in board.board.items())
+
+    def test_undo_redo(self):
+        board = pipeslib.Board(8, 6, seed=4)
+        board.generate()
+        board.jumble()
+        # The first snapshot is taken by jumble, not by the first move.
+        self.assertIsNotNone(board._position)
+
+        states = [self.state(board)]
+        board.rotate_square((2, 3))
+        states.append(self.state(board))
+        board.fix_square((5, 1), board.board[(5, 1)].connections[-1])
+        states.append(self.state(board))
+        board.rotate_square((2, 3), clockwise=False)
+        states.append(self.state(board))
+
+        for state in reversed(states[:-1]):
+            self.assertIsNotNone(board.undo())
+            self.assertEqual(self.state(board), state)
+        self.assertIsNone(board.undo())
+        for state in states[1:]:
+            self.assertIsNotNone(board.redo())
+            self.assertEqual(self.state(board), state)
+        self.assertIsNone(board.redo())
+
+
+if __name__ == '__main__':
+    unittest.main()